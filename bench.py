@@ -0,0 +1,119 @@
+"""Drives a whole PaperTerm, bash included, against the simulated
+hardware in `fakes`, and reports keystroke-to-pixel latency, frame rate
+and bus traffic.
+
+    python bench.py FONT_PATH [KEYSTROKES] [--event-loop]
+
+"""
+import sys
+import time
+from threading import Thread
+from evdev import ecodes
+
+from fakes import FakeGpio, FakeSpi, FakeSMBus, FakeInputDevice
+from pervasive import PervasiveDisplay
+from stats import Stats
+from main import PaperTerm
+
+def type_text(keyboard, text):
+    """Press the keys for lower-case letters, digits, spaces and
+    newlines."""
+    names = {" ": "KEY_SPACE", "\n": "KEY_ENTER"}
+    for char in text:
+        keyboard.press(ecodes.ecodes[names.get(char, "KEY_%s" % char.upper())])
+
+def wait_until_idle(spi, quiet=2.0, timeout=60.0):
+    """Wait until no refresh has started for `quiet` seconds."""
+    deadline = time.time() + timeout
+    seen = spi.refreshes
+    while time.time() < deadline:
+        count = spi.wait_for_refresh(seen, quiet)
+        if count == seen:
+            return
+        seen = count
+
+def keystroke_latency(keyboard, spi, count):
+    """Type `count` characters one at a time, timing each from the key
+    event to the start of the refresh that shows it."""
+    latencies = []
+    for i in range(count):
+        seen = spi.refreshes
+        pressed = time.time()
+        type_text(keyboard, "x")
+        if spi.wait_for_refresh(seen, 10.0) > seen:
+            latencies.append(spi.last_refresh_time - pressed)
+    for i in range(count):
+        keyboard.press(ecodes.KEY_BACKSPACE) # leave a clean prompt behind
+    return latencies
+
+def output_throughput(keyboard, spi, lcd_bus, command):
+    """Run `command` and count the frames and bus bytes until the
+    screen settles."""
+    frames, spi_bytes, i2c_bytes = (spi.refreshes, spi.bytes_written,
+                                    lcd_bus.bytes_written)
+    start = time.time()
+    type_text(keyboard, command + "\n")
+    # flood mode holds frames back for up to the scheduler's
+    # max_staleness, so quiet has to last longer than that
+    wait_until_idle(spi, quiet=4.0)
+    elapsed = time.time() - start
+    return (spi.refreshes - frames, elapsed,
+            spi.bytes_written - spi_bytes, lcd_bus.bytes_written - i2c_bytes)
+
+def main(font_path, keystrokes=20, event_loop=False):
+    gpio = FakeGpio()
+    spi = FakeSpi(gpio)
+    lcd_bus = FakeSMBus()
+    keyboard = FakeInputDevice()
+    stats = Stats()
+
+    term = PaperTerm(keyboard, None,
+                     display=PervasiveDisplay(gpio=gpio, spi=spi, stats=stats),
+                     stats=stats,
+                     lcd_bus=lcd_bus,
+                     font_path=font_path,
+                     use_lcd=True,
+                     event_loop=event_loop)
+    term.__enter__()
+    runner = Thread(target=term.start)
+    runner.daemon = True
+    runner.start()
+
+    # let bash come up and the prompt reach the panel
+    spi.wait_for_refresh(0, 30.0)
+    wait_until_idle(spi)
+    print("startup: %s" % term.startup_report())
+
+    latencies = sorted(keystroke_latency(keyboard, spi, keystrokes))
+    wait_until_idle(spi)
+    if latencies:
+        print("keystroke to pixel: median %.3fs, worst %.3fs (%d of %d shown)"
+              % (latencies[len(latencies) // 2], latencies[-1],
+                 len(latencies), keystrokes))
+    else:
+        print("keystroke to pixel: no keystroke reached the panel")
+
+    frames, elapsed, spi_bytes, i2c_bytes = output_throughput(
+        keyboard, spi, lcd_bus, "seq 1 20000")
+    print("output burst: %d frames in %.2fs (%.2f fps)"
+          % (frames, elapsed, frames / elapsed))
+    if frames:
+        print("bus traffic: %d SPI bytes per frame, %d I2C bytes per frame"
+              % (spi_bytes // frames, i2c_bytes // frames))
+    print("SPI bus busy %.2fs, I2C bus busy %.2fs, panel BUSY waits %.2fs"
+          % (spi.bus_time, lcd_bus.bus_time, term.display.busy_wait_time))
+    print("scheduler: %(frames)d frames, %(deferred)d deferred, "
+          "%(coalesced)d coalesced, %(dropped)d dropped, %(skipped)d skipped"
+          % term.scheduler.stats())
+
+    report = stats.report()
+    for name, timer in sorted(report["timers"].items()):
+        print("%-15s %7d x  mean %8.5fs  p90 %8.5fs  max %8.5fs"
+              % (name, timer["count"], timer["mean"], timer["p90"],
+                 timer["max"]))
+    print(", ".join("%s %d" % item for item in sorted(report["counters"].items())))
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if arg != "--event-loop"]
+    main(args[0], *[int(arg) for arg in args[1:2]],
+         event_loop="--event-loop" in sys.argv)
@@ -0,0 +1,620 @@
+"""A pyte Screen that keeps its cells in two flat arrays, rather than as
+Char namedtuples in a dict of dicts, so its memory is fixed by its
+size and redrawing a row means slicing an array.
+
+Each cell is a code, its text, and an attribute word: the flag bits
+below, WRITTEN, and above those the index of its (fg, bg) colours.
+
+"""
+import unicodedata
+from array import array
+
+import pyte
+from pyte import modes as mo
+from pyte.screens import Char, Margins
+from wcwidth import wcwidth
+
+# attribute word flags, in the order of Char's fields
+BOLD = 1
+ITALICS = 2
+UNDERSCORE = 4
+STRIKETHROUGH = 8
+REVERSE = 16
+BLINK = 32
+_FLAGS = ((BOLD, "bold"), (ITALICS, "italics"), (UNDERSCORE, "underscore"),
+          (STRIKETHROUGH, "strikethrough"), (REVERSE, "reverse"),
+          (BLINK, "blink"))
+
+# set on cells that have been written to, as opposed to blank ones
+# pyte has never stored a Char for (it erases only the former)
+WRITTEN = 64
+
+COLOUR_SHIFT = 8
+
+# a cell whose text isn't one code point (the empty stub after a wide
+# character, or one with combining marks NFC couldn't fold) holds
+# STRINGS_BASE plus the index of its text in _strings
+STRINGS_BASE = 0x110000
+_strings = [""]
+_string_codes = {"": STRINGS_BASE}
+
+# the (fg, bg) pairs attribute words refer to, and the words of the
+# styles seen so far; shared by every screen, so words can be
+# compared and copied between them
+_colours = [("default", "default")]
+_colour_index = {_colours[0]: 0}
+_words = {}
+
+# the tables above live as long as the process and codes already in
+# screens and scrollback point into them, so rather than forget
+# anything they stop growing: past MAX_STRINGS a new text keeps only
+# its first character, and past MAX_COLOURS a new pair of colours is
+# shown in the default ones (the panel only shows BOLD and REVERSE);
+# the colour index so stays well inside its 24 bits
+MAX_STRINGS = 4096
+MAX_COLOURS = 1024
+MAX_WORDS = 4096
+
+def text_code(text):
+    """Return the code of a cell holding `text`."""
+    if len(text) == 1:
+        return ord(text)
+    try:
+        return _string_codes[text]
+    except KeyError:
+        pass
+    if len(_strings) >= MAX_STRINGS:
+        return ord(text[0])
+    _strings.append(text)
+    code = _string_codes[text] = STRINGS_BASE + len(_strings) - 1
+    return code
+
+def code_text(code):
+    """Return the text of a cell holding `code`."""
+    if code < STRINGS_BASE:
+        return chr(code)
+    return _strings[code - STRINGS_BASE]
+
+def attr_word(char):
+    """Return the attribute word for the style of the Char `char`,
+    without WRITTEN."""
+    key = char[1:]
+    try:
+        return _words[key]
+    except KeyError:
+        pass
+
+    colours = (char.fg, char.bg)
+    index = _colour_index.get(colours)
+    if index is None:
+        if len(_colours) < MAX_COLOURS:
+            index = _colour_index[colours] = len(_colours)
+            _colours.append(colours)
+        else:
+            index = 0
+    word = index << COLOUR_SHIFT
+    for flag, name in _FLAGS:
+        if getattr(char, name):
+            word |= flag
+    if len(_words) < MAX_WORDS:
+        _words[key] = word
+    return word
+
+def make_char(code, word):
+    """Return the Char for a cell."""
+    fg, bg = _colours[word >> COLOUR_SHIFT]
+    return Char(code_text(code), fg, bg, *[bool(word & flag)
+                                           for flag, name in _FLAGS])
+
+
+class DirtyRows(object):
+    """The rows changed since it was last cleared, as a flag byte per
+    row; used like the set pyte keeps in Screen.dirty, but never grows.
+    Rows outside the screen are ignored.
+
+    """
+    def __init__(self, lines):
+        self.resize(lines)
+
+    def resize(self, lines):
+        old = getattr(self, "_flags", b"")
+        self._flags = bytearray(lines)
+        self._flags[:len(old)] = old[:lines]
+        self._ones = b"\x01" * lines
+        self._zeros = bytes(lines)
+
+    def add(self, y):
+        if 0 <= y < len(self._flags):
+            self._flags[y] = 1
+
+    def discard(self, y):
+        if 0 <= y < len(self._flags):
+            self._flags[y] = 0
+
+    def update(self, rows):
+        if isinstance(rows, range) and rows.step == 1:
+            start, stop = max(rows.start, 0), min(rows.stop, len(self._flags))
+            if start < stop:
+                self._flags[start:stop] = self._ones[start:stop]
+        else:
+            for y in rows:
+                self.add(y)
+
+    def clear(self):
+        self._flags[:] = self._zeros
+
+    def __contains__(self, y):
+        return 0 <= y < len(self._flags) and self._flags[y] == 1
+
+    def __iter__(self):
+        flags = self._flags
+        y = flags.find(1)
+        while y >= 0:
+            yield y
+            y = flags.find(1, y + 1)
+
+    def __len__(self):
+        return self._flags.count(1)
+
+    def __bool__(self):
+        return 1 in self._flags
+
+    def __repr__(self):
+        return "DirtyRows(%r)" % list(self)
+
+
+class _Line(object):
+    """Row `y` of a CellScreen, looking like the dict of Chars by column
+    pyte keeps per row: reading a blank cell gives the screen's
+    default_char, and only written cells are its keys."""
+    def __init__(self, screen, y):
+        self.screen = screen
+        self.y = y
+
+    def _index(self, x):
+        screen = self.screen
+        if 0 <= x < screen.columns and 0 <= self.y < screen.lines:
+            return self.y * screen.columns + x
+        return None
+
+    @property
+    def default(self):
+        return self.screen.default_char
+
+    @default.setter
+    def default(self, char):
+        # blank cells show whatever the default is now
+        screen, word = self.screen, attr_word(char)
+        start = self._index(0)
+        if start is not None:
+            for index in range(start, start + screen.columns):
+                if not screen.attrs[index] & WRITTEN:
+                    screen.attrs[index] = word
+
+    def __getitem__(self, x):
+        index = self._index(x)
+        if index is None:
+            return self.screen.default_char
+        return make_char(self.screen.codes[index], self.screen.attrs[index])
+
+    def __setitem__(self, x, char):
+        index = self._index(x)
+        if index is not None:
+            self.screen.codes[index] = text_code(char.data)
+            self.screen.attrs[index] = attr_word(char) | WRITTEN
+
+    def __contains__(self, x):
+        index = self._index(x)
+        return index is not None and self.screen.attrs[index] & WRITTEN != 0
+
+    def pop(self, x, default=None):
+        if x not in self:
+            return default
+        char = self[x]
+        index = self._index(x)
+        self.screen.codes[index] = 32
+        self.screen.attrs[index] = attr_word(self.screen.default_char)
+        return char
+
+    def keys(self):
+        return [x for x in range(self.screen.columns) if x in self]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def values(self):
+        return [self[x] for x in self.keys()]
+
+    def items(self):
+        return [(x, self[x]) for x in self.keys()]
+
+
+class _Buffer(object):
+    """The rows of a CellScreen, looking like pyte's Screen.buffer."""
+    def __init__(self, screen):
+        self.screen = screen
+
+    def __getitem__(self, y):
+        return _Line(self.screen, y)
+
+    def __setitem__(self, y, line):
+        screen = self.screen
+        if not 0 <= y < screen.lines:
+            return
+        if isinstance(line, _Line) and line.screen is screen:
+            screen._move_rows(line.y, line.y + 1, y)
+        else:
+            screen._clear_rows(y, y + 1)
+            target = self[y]
+            for x, char in line.items():
+                target[x] = char
+
+    def pop(self, y, default=None):
+        if y not in self:
+            return default
+        line = dict(self[y].items())
+        self.screen._clear_rows(y, y + 1)
+        return line
+
+    def __contains__(self, y):
+        return 0 <= y < self.screen.lines
+
+    def keys(self):
+        return range(self.screen.lines)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return self.screen.lines
+
+    def values(self):
+        return [self[y] for y in self.keys()]
+
+    def items(self):
+        return [(y, self[y]) for y in self.keys()]
+
+    def clear(self):
+        self.screen._clear_rows(0, self.screen.lines)
+
+
+class CellScreen(pyte.Screen):
+    """A pyte Screen whose cells live in `codes` and `attrs`, arrays of
+    `columns` per row (see above), with `dirty` a DirtyRows.  `row`
+    gives views of a row without copying it, `copy_row` a copy, and
+    `buffer` still works as pyte's does, only more slowly.
+
+    Where pyte's own bookkeeping leaks into what is shown, this does
+    what pyte 0.8 does, except that a cell pushed off the end of a row
+    by an insert is gone, rows deleted or inserted come up blank
+    whether pyte had stored them or not, and resizing keeps the cursor
+    on the screen.
+
+    """
+    def __init__(self, columns, lines):
+        self.savepoints = []
+        self.columns = columns
+        self.lines = lines
+        self.mode = set([mo.DECAWM, mo.DECTCEM])
+        self.codes = array("I", [32]) * (columns * lines)
+        self.attrs = array("I", [0]) * (columns * lines)
+        self.dirty = DirtyRows(lines)
+        self.reset()
+        self.margins = None
+
+    @property
+    def buffer(self):
+        return _Buffer(self)
+
+    def row(self, y):
+        """Return views of the codes and attribute words of row `y`."""
+        start = y * self.columns
+        return (memoryview(self.codes)[start:start + self.columns],
+                memoryview(self.attrs)[start:start + self.columns])
+
+    def copy_row(self, y):
+        """Return copies of the codes and attribute words of row `y`."""
+        start = y * self.columns
+        end = start + self.columns
+        return self.codes[start:end], self.attrs[start:end]
+
+    def row_text(self, y):
+        """Return the text of every cell of row `y`, wide characters'
+        stubs included."""
+        codes, attrs = self.copy_row(y)
+        if max(codes) < STRINGS_BASE:
+            return "".join(map(chr, codes))
+        return "".join(map(code_text, codes))
+
+    @property
+    def display(self):
+        out = []
+        for y in range(self.lines):
+            codes, attrs = self.copy_row(y)
+            if max(codes) < 0x1100 and min(codes):
+                # nothing wide or empty
+                out.append("".join(map(chr, codes)))
+                continue
+            text, wide = [], False
+            for code in codes:
+                if wide: # skip the stub
+                    wide = False
+                    continue
+                char = code_text(code)
+                # a stub whose character was overwritten shows as
+                # nothing (pyte fails on one)
+                wide = bool(char) and wcwidth(char[0]) == 2
+                text.append(char)
+            out.append("".join(text))
+        return out
+
+    def _clear_rows(self, start, stop):
+        """Blank rows `start` up to `stop`."""
+        size = (stop - start) * self.columns
+        if size > 0:
+            first = start * self.columns
+            self.codes[first:first + size] = array("I", [32]) * size
+            self.attrs[first:first + size] = (
+                array("I", [attr_word(self.default_char)]) * size)
+
+    def _move_rows(self, start, stop, to):
+        """Copy rows `start` up to `stop` over those from `to` on."""
+        columns = self.columns
+        source = slice(start * columns, stop * columns)
+        target = slice(to * columns, (to + stop - start) * columns)
+        self.codes[target] = self.codes[source]
+        self.attrs[target] = self.attrs[source]
+
+    def _fill(self, start, stop, char):
+        """Write `char` over cells `start` up to `stop` of the cursor's
+        row."""
+        if start < stop:
+            first = self.cursor.y * self.columns
+            size = stop - start
+            self.codes[first + start:first + stop] = (
+                array("I", [text_code(char.data)]) * size)
+            self.attrs[first + start:first + stop] = (
+                array("I", [attr_word(char) | WRITTEN]) * size)
+
+    def reset(self):
+        pyte.Screen.reset(self)
+        # again, now the mode (and so the default character) is reset
+        self._clear_rows(0, self.lines)
+
+    def resize(self, lines=None, columns=None):
+        lines = lines or self.lines
+        columns = columns or self.columns
+        if lines == self.lines and columns == self.columns:
+            return
+
+        self.dirty.resize(lines)
+        self.dirty.update(range(lines))
+        if lines < self.lines:
+            self.save_cursor()
+            self.cursor_position(0, 0)
+            self.delete_lines(self.lines - lines) # drop from the top
+            self.restore_cursor()
+
+        codes, attrs, old_columns = self.codes, self.attrs, self.columns
+        self.codes = array("I", [32]) * (columns * lines)
+        self.attrs = array("I", [0]) * (columns * lines)
+        self.lines, self.columns = lines, columns
+        self._clear_rows(0, lines)
+        width = min(columns, old_columns)
+        for y in range(min(lines, len(codes) // old_columns)):
+            self.codes[y * columns:y * columns + width] = (
+                codes[y * old_columns:y * old_columns + width])
+            self.attrs[y * columns:y * columns + width] = (
+                attrs[y * old_columns:y * old_columns + width])
+
+        # a cursor past the last row or column would draw into the next
+        self.cursor.x = min(self.cursor.x, columns)
+        self.cursor.y = min(self.cursor.y, lines - 1)
+        self.set_margins()
+
+    def draw(self, data):
+        data = data.translate(
+            self.g1_charset if self.charset else self.g0_charset)
+        if (data.isascii() and data.isprintable() and
+                mo.DECAWM in self.mode and mo.IRM not in self.mode):
+            self._draw_ascii(data)
+        else:
+            self._draw_chars(data)
+        self.dirty.add(self.cursor.y)
+
+    def _draw_ascii(self, data):
+        """Draw printable ASCII with wrapping on, a row at a time."""
+        cursor, columns = self.cursor, self.columns
+        word = attr_word(cursor.attrs) | WRITTEN
+        start = 0
+        while start < len(data):
+            if cursor.x == columns:
+                self.dirty.add(cursor.y)
+                self.carriage_return()
+                self.linefeed()
+            chunk = data[start:start + columns - cursor.x]
+            size = len(chunk)
+            first = cursor.y * columns + cursor.x
+            self.codes[first:first + size] = array("I", map(ord, chunk))
+            self.attrs[first:first + size] = array("I", [word]) * size
+            cursor.x += size
+            start += size
+
+    def _draw_chars(self, data):
+        """Draw anything, a character at a time, as pyte does."""
+        cursor, columns, codes, attrs = (self.cursor, self.columns,
+                                         self.codes, self.attrs)
+        word = attr_word(cursor.attrs) | WRITTEN
+        for char in data:
+            char_width = wcwidth(char)
+
+            if cursor.x == columns:
+                if mo.DECAWM in self.mode:
+                    self.dirty.add(cursor.y)
+                    self.carriage_return()
+                    self.linefeed()
+                elif char_width > 0:
+                    cursor.x -= char_width
+
+            if mo.IRM in self.mode and char_width > 0:
+                self.insert_characters(char_width)
+
+            index = cursor.y * columns + cursor.x
+            if char_width == 1:
+                codes[index], attrs[index] = ord(char), word
+            elif char_width == 2:
+                # a two-cell character has a stub after it
+                codes[index], attrs[index] = ord(char), word
+                if cursor.x + 1 < columns:
+                    codes[index + 1] = STRINGS_BASE
+                    attrs[index + 1] = word
+            elif char_width == 0 and unicodedata.combining(char):
+                # combined with the character before, which may be on
+                # the row above
+                if cursor.x or cursor.y:
+                    index -= 1
+                    codes[index] = text_code(unicodedata.normalize(
+                        "NFC", code_text(codes[index]) + char))
+                    attrs[index] |= WRITTEN
+            else:
+                break # unprintable, or doesn't move the cursor
+
+            if char_width > 0:
+                cursor.x = min(cursor.x + char_width, columns)
+
+    def index(self):
+        top, bottom = self.margins or Margins(0, self.lines - 1)
+        if self.cursor.y == bottom:
+            self.dirty.update(range(self.lines))
+            self._move_rows(top + 1, bottom + 1, top)
+            self._clear_rows(bottom, bottom + 1)
+        else:
+            self.cursor_down()
+
+    def reverse_index(self):
+        top, bottom = self.margins or Margins(0, self.lines - 1)
+        if self.cursor.y == top:
+            self.dirty.update(range(self.lines))
+            self._move_rows(top, bottom, top + 1)
+            self._clear_rows(top, top + 1)
+        else:
+            self.cursor_up()
+
+    def insert_lines(self, count=None):
+        count = count or 1
+        top, bottom = self.margins or Margins(0, self.lines - 1)
+        y = self.cursor.y
+        if top <= y <= bottom:
+            self.dirty.update(range(y, self.lines))
+            if y + count <= bottom:
+                self._move_rows(y, bottom + 1 - count, y + count)
+            self._clear_rows(y, min(y + count, bottom + 1))
+            self.carriage_return()
+
+    def delete_lines(self, count=None):
+        count = count or 1
+        top, bottom = self.margins or Margins(0, self.lines - 1)
+        y = self.cursor.y
+        if top <= y <= bottom:
+            self.dirty.update(range(y, self.lines))
+            if y + count <= bottom:
+                self._move_rows(y + count, bottom + 1, y)
+            self._clear_rows(max(bottom + 1 - count, y), bottom + 1)
+            self.carriage_return()
+
+    def _mark_written(self, start, stop):
+        first = self.cursor.y * self.columns
+        for index in range(first + start, first + stop):
+            self.attrs[index] |= WRITTEN
+
+    def insert_characters(self, count=None):
+        self.dirty.add(self.cursor.y)
+        count = count or 1
+        x, columns = self.cursor.x, self.columns
+        first = self.cursor.y * columns
+        if x + count < columns:
+            moved = slice(first + x, first + columns - count)
+            self.codes[first + x + count:first + columns] = self.codes[moved]
+            self.attrs[first + x + count:first + columns] = self.attrs[moved]
+            # pyte copies blank cells as written ones
+            self._mark_written(x + count, columns)
+        self._clear_cells(x, min(x + count, columns))
+
+    def delete_characters(self, count=None):
+        self.dirty.add(self.cursor.y)
+        count = count or 1
+        x, columns = self.cursor.x, self.columns
+        first = self.cursor.y * columns
+        if x + count < columns:
+            moved = slice(first + x + count, first + columns)
+            self.codes[first + x:first + columns - count] = self.codes[moved]
+            self.attrs[first + x:first + columns - count] = self.attrs[moved]
+            self._mark_written(x, columns - count)
+        if x <= columns - count:
+            # pyte fills the first cell freed with a written blank
+            self._fill(columns - count, columns - count + 1,
+                       self.default_char)
+        self._clear_cells(max(x, columns - count + 1), columns)
+
+    def _clear_cells(self, start, stop):
+        """Blank cells `start` up to `stop` of the cursor's row."""
+        if start < stop:
+            first = self.cursor.y * self.columns
+            size = stop - start
+            self.codes[first + start:first + stop] = array("I", [32]) * size
+            self.attrs[first + start:first + stop] = (
+                array("I", [attr_word(self.default_char)]) * size)
+
+    def erase_characters(self, count=None):
+        self.dirty.add(self.cursor.y)
+        count = count or 1
+        self._fill(self.cursor.x, min(self.cursor.x + count, self.columns),
+                   self.cursor.attrs)
+
+    def erase_in_line(self, how=0, private=False):
+        if how == 0:
+            start, stop = self.cursor.x, self.columns
+        elif how == 1:
+            start, stop = 0, min(self.cursor.x + 1, self.columns)
+        elif how == 2:
+            start, stop = 0, self.columns
+        else:
+            return
+        self.dirty.add(self.cursor.y)
+        self._fill(start, stop, self.cursor.attrs)
+
+    def erase_in_display(self, how=0, *args, **kwargs):
+        if how == 0:
+            interval = range(self.cursor.y + 1, self.lines)
+        elif how == 1:
+            interval = range(self.cursor.y)
+        elif how == 2 or how == 3:
+            interval = range(self.lines)
+        else:
+            return
+
+        self.dirty.update(interval)
+        if interval:
+            # as in pyte, only cells written to take the cursor's style
+            code = text_code(self.cursor.attrs.data)
+            word = attr_word(self.cursor.attrs) | WRITTEN
+            cells = slice(interval.start * self.columns,
+                          interval.stop * self.columns)
+            attrs = self.attrs[cells]
+            self.codes[cells] = array("I", [
+                code if old & WRITTEN else old_code
+                for old, old_code in zip(attrs, self.codes[cells])])
+            self.attrs[cells] = array("I", [
+                word if old & WRITTEN else old for old in attrs])
+
+        if how == 0 or how == 1:
+            self.erase_in_line(how)
+
+    def alignment_display(self):
+        self.dirty.update(range(self.lines))
+        size = self.lines * self.columns
+        self.codes[:] = array("I", [ord("E")]) * size
+        self.attrs[:] = array("I", [word | WRITTEN for word in self.attrs])
@@ -0,0 +1,76 @@
+import numpy as np
+
+# native geometry of the panel, which is mounted rotated: its rows run
+# down the landscape screen, right to left
+WIDTH = 480
+HEIGHT = 800
+
+class EpdFrame(object):
+    """A framebuffer kept in the panel's own layout, ready to upload.
+
+    This is the layout `pil2epd.convert` produces from a landscape
+    image turned with `rotate(270)`: portrait rows of WIDTH / 8 bytes,
+    one bit per pixel, most significant bit leftmost, set bits black.
+    Callers draw in landscape coordinates and the frame does the
+    rotation as it goes, so a refresh never has to rotate or convert
+    the whole screen.
+
+    Pixels are kept unpacked, one byte each, so cells can be copied in
+    with plain slicing; only the byte columns touched since the last
+    upload are re-packed in `tobytes`.
+
+    """
+    def __init__(self, width=WIDTH, height=HEIGHT):
+        self.width = width
+        self.height = height
+        self.pixels = np.zeros((height, width), dtype=np.uint8)
+        self.packed = np.zeros((height, width // 8), dtype=np.uint8)
+        self._stale = None # (first, last + 1) pixel columns to repack
+
+    def prepare(self, cell):
+        """Turn a landscape PIL mode "1" cell into the array `blit` takes:
+        rotated into panel orientation, 1 meaning black.
+
+        """
+        ink = np.logical_not(np.array(cell, dtype=bool))
+        return np.ascontiguousarray(np.rot90(ink, -1), dtype=np.uint8)
+
+    def _touch(self, first, last):
+        if self._stale:
+            first = min(first, self._stale[0])
+            last = max(last, self._stale[1])
+        self._stale = (first, last)
+
+    def blit(self, cell, x, y):
+        """Copy a prepared cell in with its top left corner at landscape
+        (x, y), raising ValueError if any of it would be off the frame."""
+        rows, cols = cell.shape
+        col = self.width - y - cols
+        if x < 0 or col < 0 or x + rows > self.height or y < 0:
+            # numpy would wrap negative offsets round, or fail to
+            # broadcast a cell cut short
+            raise ValueError("a %dx%d cell at (%d, %d) is off the frame"
+                             % (rows, cols, x, y))
+        self.pixels[x:x + rows, col:col + cols] = cell
+        self._touch(col, col + cols)
+
+    def box(self, x0, y0, x1, y1):
+        """Draw the outline of the landscape rectangle with corners (x0, y0)
+        and (x1, y1), inclusive, as `ImageDraw.rectangle` would."""
+        first, last = self.width - 1 - y1, self.width - 1 - y0
+        pixels = self.pixels
+        pixels[x0, first:last + 1] = 1
+        pixels[x1, first:last + 1] = 1
+        pixels[x0:x1 + 1, first] = 1
+        pixels[x0:x1 + 1, last] = 1
+        self._touch(first, last + 1)
+
+    def tobytes(self):
+        """Return the whole frame, packed, as a memoryview onto the frame's
+        own buffer."""
+        if self._stale:
+            first, last = self._stale[0] // 8, (self._stale[1] + 7) // 8
+            self.packed[:, first:last] = np.packbits(
+                self.pixels[:, first * 8:last * 8], axis=1)
+            self._stale = None
+        return memoryview(self.packed).cast("B")
@@ -0,0 +1,299 @@
+import os
+import queue
+import random
+import select
+import time
+from threading import Condition
+
+class FakeGpio(object):
+    """Drop-in for the `RPi.GPIO` module, simulating the pins instead of
+    driving them.  Outputs remember what was last written; inputs read
+    HIGH unless `hold_low` has pulled them down, which models a BUSY
+    line that the panel releases after a given time.
+
+    """
+    BOARD = 10
+    BCM = 11
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self):
+        self.mode = None
+        self.pins = {}
+        self._low_until = {}
+        self._changed = Condition()
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, channel, direction, **kwargs):
+        self.pins.setdefault(channel, self.HIGH)
+
+    def output(self, channel, value):
+        self.pins[channel] = value
+
+    def cleanup(self):
+        self.pins.clear()
+        self._low_until.clear()
+
+    def hold_low(self, channel, seconds):
+        """Pull input `channel` low for `seconds`; float("inf") simulates
+        a hung panel."""
+        with self._changed:
+            self._low_until[channel] = time.monotonic() + seconds
+            self._changed.notify_all()
+
+    def input(self, channel):
+        if time.monotonic() < self._low_until.get(channel, 0):
+            return self.LOW
+        return self.pins.get(channel, self.HIGH)
+
+    def wait_for_edge(self, channel, edge, timeout=None):
+        """Sleep until a held-low `channel` is released, returning the
+        channel, or None once `timeout` milliseconds pass.  Only the
+        rising edge at the end of a `hold_low` is simulated, and, as
+        with RPi.GPIO, only one after the call: if the pin was already
+        released, the edge is missed and the call waits out `timeout`
+        (or for the next `hold_low` to end).
+
+        """
+        armed = time.monotonic()
+        deadline = float("inf")
+        if timeout is not None:
+            deadline = armed + timeout / 1000.0
+        with self._changed:
+            while True:
+                now = time.monotonic()
+                release = self._low_until.get(channel, 0)
+                if armed < release <= now:
+                    return channel
+                if deadline <= now:
+                    return None
+                if release <= armed:
+                    release = float("inf") # gone before we looked
+                wait = min(release, deadline) - now
+                self._changed.wait(None if wait == float("inf") else wait)
+
+class FakeSpi(object):
+    """Drop-in for `spidev.SpiDev`, wired to a simulated e-paper panel.
+
+    Every write is counted, and takes as long as it would on a bus
+    clocked at `max_speed_hz`.  Afterwards the panel holds the BUSY pin
+    of `gpio` low for `command_time` seconds, or `refresh_time` after
+    an update_display command.  Reads return the controller's success
+    status, except that a fraction `error_rate` of them (and the next
+    few after a call to `glitch`) return an error status instead, as
+    after a bus glitch.  Clocked faster than `max_reliable_hz`, one
+    read in ten fails.  With `record`, every write is also kept in
+    `transfers`.
+
+    """
+    def __init__(self, gpio=None, busy_pin=16, command_time=0.0002,
+                 refresh_time=0.8, realtime=True, record=False,
+                 error_rate=0.0, seed=None, max_reliable_hz=None):
+        self.gpio = gpio
+        self.busy_pin = busy_pin
+        self.command_time = command_time
+        self.refresh_time = refresh_time
+        self.realtime = realtime
+        self.record = record
+        self.error_rate = error_rate
+        self.max_reliable_hz = max_reliable_hz
+        self._random = random.Random(seed)
+        self._glitches = 0
+
+        self.max_speed_hz = 500000 # spidev's default
+        self.mode = 0
+        self.bits_per_word = 8
+
+        self.transfers = []
+        self.writes = 0
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self.bus_time = 0.0
+        self.refreshes = 0
+        self.last_refresh_time = None
+        self.errors = 0
+        self._refreshed = Condition()
+
+    def open(self, bus, device):
+        pass
+
+    def close(self):
+        pass
+
+    def _clock(self, count):
+        seconds = count * 8.0 / self.max_speed_hz
+        self.bus_time += seconds
+        if self.realtime:
+            time.sleep(seconds)
+
+    def _write(self, data):
+        data = bytes(data)
+        self.writes += 1
+        self.bytes_written += len(data)
+        if self.record:
+            self.transfers.append(data)
+        self._clock(len(data))
+
+        refresh = data[:1] == b"\x24"
+        if self.gpio is not None:
+            self.gpio.hold_low(self.busy_pin, self.refresh_time if refresh
+                               else self.command_time)
+        if refresh:
+            with self._refreshed:
+                self.refreshes += 1
+                self.last_refresh_time = time.time()
+                self._refreshed.notify_all()
+
+    def writebytes(self, data):
+        self._write(data)
+
+    def writebytes2(self, data):
+        self._write(data)
+
+    def xfer2(self, data):
+        self._write(data)
+        return [0] * len(data)
+
+    def glitch(self, count=1):
+        """Make the next `count` reads return an error status."""
+        self._glitches += count
+
+    def readbytes(self, count):
+        self.bytes_read += count
+        self._clock(count)
+        status = [0x90, 0x00]
+        error_rate = self.error_rate
+        if self.max_reliable_hz and self.max_speed_hz > self.max_reliable_hz:
+            error_rate = max(error_rate, 0.1)
+        if self._glitches or (error_rate and
+                              self._random.random() < error_rate):
+            self._glitches = max(self._glitches - 1, 0)
+            self.errors += 1
+            status = [0x6F, 0x00]
+        return (status + [0] * count)[:count]
+
+    def wait_for_refresh(self, seen, timeout=None):
+        """Block until more than `seen` refreshes have been started, or
+        `timeout` seconds pass; return the refresh count."""
+        with self._refreshed:
+            self._refreshed.wait_for(lambda: self.refreshes > seen, timeout)
+            return self.refreshes
+
+
+class FakeSMBus(object):
+    """Drop-in for `smbus.SMBus`.  Writes are counted, and take as long
+    as they would on a bus clocked at `hz`: nine bits per byte,
+    counting the address byte, plus start and stop.
+
+    """
+    def __init__(self, hz=100000, realtime=True, record=False):
+        self.hz = hz
+        self.realtime = realtime
+        self.record = record
+
+        self.transactions = []
+        self.writes = 0
+        self.bytes_written = 0
+        self.bus_time = 0.0
+
+    def _write(self, addr, data):
+        self.writes += 1
+        self.bytes_written += len(data)
+        if self.record:
+            self.transactions.append((addr, bytes(data)))
+        seconds = ((1 + len(data)) * 9 + 2) / float(self.hz)
+        self.bus_time += seconds
+        if self.realtime:
+            time.sleep(seconds)
+
+    def write_byte(self, addr, value):
+        self._write(addr, [value])
+
+    def write_byte_data(self, addr, cmd, value):
+        self._write(addr, [cmd, value])
+
+    def write_block_data(self, addr, cmd, data):
+        self._write(addr, [cmd, len(data)] + list(data))
+
+    def write_i2c_block_data(self, addr, cmd, data):
+        self._write(addr, [cmd] + list(data))
+
+    def read_byte(self, addr):
+        return 0
+
+    def read_byte_data(self, addr, cmd):
+        return 0
+
+    def read_block_data(self, addr, cmd):
+        return []
+
+
+class FakeEvent(object):
+    """Stands in for `evdev.InputEvent`."""
+    def __init__(self, type, code, value, stamp):
+        self.type = type
+        self.code = code
+        self.value = value
+        self.sec = int(stamp)
+        self.usec = int((stamp - self.sec) * 1000000)
+
+    def timestamp(self):
+        return self.sec + self.usec / 1000000.0
+
+
+class FakeInputDevice(object):
+    """Drop-in for `evdev.InputDevice`.  Key events queued with `send` or
+    `press` come out of `read_loop` or `read`, stamped with the time
+    they were queued.  A pipe stands in for the device's file
+    descriptor, so it works with select() too.
+
+    """
+    EV_KEY = 1
+
+    def __init__(self, fn="/dev/input/fake", name="Fake Keyboard"):
+        self.fn = fn
+        self.name = name
+        self.grabbed = False
+        self._events = queue.Queue()
+        self._signal, self._signal_in = os.pipe()
+
+    def grab(self):
+        self.grabbed = True
+
+    def ungrab(self):
+        self.grabbed = False
+
+    def send(self, code, value, type=EV_KEY):
+        self._events.put(FakeEvent(type, code, value, time.time()))
+        os.write(self._signal_in, b"!")
+
+    def press(self, code):
+        """Queue a key going down then up."""
+        self.send(code, 1)
+        self.send(code, 0)
+
+    def fileno(self):
+        return self._signal
+
+    def read_loop(self):
+        while True:
+            os.read(self._signal, 1)
+            yield self._events.get()
+
+    def read(self):
+        """Return the events waiting, or raise BlockingIOError if none
+        are."""
+        if not select.select([self._signal], [], [], 0)[0]:
+            raise BlockingIOError()
+        count = len(os.read(self._signal, 4096))
+        return [self._events.get() for i in range(count)]
@@ -0,0 +1,65 @@
+import os
+import json
+
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or
+                         os.path.expanduser("~/.cache"), "paperterm")
+CACHE_FILE = os.path.join(CACHE_DIR, "fonts.json")
+
+def load_cache(cache_file):
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_cache(cache, cache_file):
+    """Write the cache out whole, so a crash never leaves half a file; a
+    read-only home directory just means nothing is cached."""
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        partial = cache_file + ".tmp"
+        with open(partial, "w") as f:
+            json.dump(cache, f)
+        os.replace(partial, cache_file)
+    except OSError:
+        pass
+
+def find_font(name="roboto mono", cache_file=CACHE_FILE):
+    """Return the path of the bold, upright variant of the font `name`.
+    Scanning every installed font with FontList is slow, so the answer
+    is cached, and only looked for again once the file has gone."""
+    cache = load_cache(cache_file)
+    path = cache.get("paths", {}).get(name)
+    if path and os.path.exists(path):
+        return path
+
+    from fontlist import FontList
+    try:
+        fonts = FontList.all().by_partial_name(name).bold()
+        font = [font for font in fonts
+                if font not in fonts.slanted()][0]
+    except IndexError:
+        raise Exception("You must install the %s font." % name.title())
+    path = font["path"]
+
+    cache.setdefault("paths", {})[name] = path
+    save_cache(cache, cache_file)
+    return path
+
+def cell_size(font, path, size, cache_file=CACHE_FILE):
+    """Return the (width, height) of a character cell of `font`, loaded
+    from `path` at `size`, as GlyphAtlas.measure would; remembered for
+    as long as the font file is unchanged."""
+    from glyphs import GlyphAtlas
+
+    key = "%s:%d:%d" % (path, size, os.stat(path).st_mtime)
+    cache = load_cache(cache_file)
+    try:
+        return tuple(cache["metrics"][key])
+    except KeyError:
+        pass
+
+    measured = GlyphAtlas.measure(font)
+    cache.setdefault("metrics", {})[key] = measured
+    save_cache(cache, cache_file)
+    return measured
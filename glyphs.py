@@ -0,0 +1,76 @@
+from collections import OrderedDict
+from PIL import Image, ImageDraw
+
+class GlyphAtlas(object):
+    """Holds a pre-rasterized 1-bit bitmap for every character cell a
+    monospaced font can draw, so rows of text can be composed by
+    pasting cells instead of running FreeType on every frame.
+
+    Printable ASCII is rasterized up front; anything else is
+    rasterized on first use and kept in an LRU of `cache_size`
+    entries.  Every glyph comes in bold and reverse-video variants,
+    matching pyte's character attributes.  If no `bold_font` is given,
+    bold cells are the same as regular ones.  If `prepare` is given,
+    each rasterized cell is passed through it once and the result is
+    what gets cached, e.g. to store cells in a framebuffer's own
+    layout.  A `cell_size` of (width, height) saves measuring the
+    font; see `measure`.
+
+    """
+    def __init__(self, font, bold_font=None, cache_size=512, prepare=None,
+                 cell_size=None):
+        self.font = font
+        self.bold_font = bold_font
+        self.prepare = prepare
+
+        self.cell_width, self.cell_height = cell_size or self.measure(font)
+
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+        self._ascii = {}
+        for code in range(32, 127):
+            for bold in (False, True):
+                for reverse in (False, True):
+                    key = (chr(code), bold, reverse)
+                    self._ascii[key] = self._rasterize(*key)
+
+    @staticmethod
+    def measure(font):
+        """Return the (width, height) of a character cell of `font`,
+        measured from the font rather than assumed."""
+        ascent, descent = font.getmetrics()
+        try:
+            width = font.getlength("M")
+        except AttributeError:  # Pillow < 8
+            width = font.getsize("M")[0]
+        return int(round(width)), ascent + descent
+
+    def _rasterize(self, char, bold, reverse):
+        """Draw a single cell, black on white (or white on black if
+        `reverse`)."""
+        font = self.bold_font if bold and self.bold_font else self.font
+        cell = Image.new("1", (self.cell_width, self.cell_height),
+                         0 if reverse else 1)
+        ImageDraw.Draw(cell).text((0, 0), char, font=font,
+                                  fill=1 if reverse else 0)
+        if self.prepare:
+            return self.prepare(cell)
+        return cell
+
+    def cell(self, char, bold=False, reverse=False):
+        """Return the bitmap for `char` with the given attributes."""
+        key = (char, bool(bold), bool(reverse))
+        try:
+            return self._ascii[key]
+        except KeyError:
+            pass
+
+        try:
+            cell = self._cache[key]
+            self._cache.move_to_end(key)
+        except KeyError:
+            cell = self._cache[key] = self._rasterize(*key)
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return cell
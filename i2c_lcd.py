@@ -1,4 +1,3 @@
-import smbus
 from time import *
 
 # LCD Address
@@ -50,24 +49,54 @@ En = 0b00000100 # Enable bit
 Rw = 0b00000010 # Read/Write bit
 Rs = 0b00000001 # Register select bit
 
+# DDRAM address of the start of each line
+LINE_ADDRESSES = {1: 0x00, 2: 0x40, 3: 0x14, 4: 0x54}
+
+# most port bytes one I2C block write can carry: the command byte,
+# plus up to 32 data bytes
+I2C_BLOCK_SIZE = 33
+
 
 class I2cDevice(object):
-   def __init__(self, addr, port=1):
+   # `bus` defaults to smbus.SMBus(port); anything with the same
+   # methods (such as fakes.FakeSMBus) can be passed instead.  Bytes
+   # written are counted as "i2c_bytes" in `stats`, if given
+   def __init__(self, addr, port=1, bus=None, stats=None):
       self.addr = addr
-      self.bus = smbus.SMBus(port)
+      if bus is None:
+         import smbus
+         bus = smbus.SMBus(port)
+      self.bus = bus
+      self.stats = stats
 
    # Write a single command
    def write_cmd(self, cmd):
       self.bus.write_byte(self.addr, cmd)
+      if self.stats:
+         self.stats.add("i2c_bytes", 1)
 
    # Write a command and argument
    def write_cmd_arg(self, cmd, data):
       self.bus.write_byte_data(self.addr, cmd, data)
+      if self.stats:
+         self.stats.add("i2c_bytes", 2)
 
    # Write a block of data
    def write_block_data(self, cmd, data):
       self.bus.write_block_data(self.addr, cmd, data)
 
+   # Write a run of bytes, in as few transactions as the bus allows
+   def write_bytes(self, data):
+      if self.stats:
+         self.stats.add("i2c_bytes", len(data))
+      if not hasattr(self.bus, "write_i2c_block_data"):
+         for byte in data:
+            self.bus.write_byte(self.addr, byte)
+         return
+      for start in range(0, len(data), I2C_BLOCK_SIZE):
+         block = data[start:start + I2C_BLOCK_SIZE]
+         self.bus.write_i2c_block_data(self.addr, block[0], block[1:])
+
    # Read a single byte
    def read(self):
       return self.bus.read_byte(self.addr)
@@ -83,8 +112,8 @@ class I2cDevice(object):
 
 
 class Lcd(object):
-   def __init__(self, address=ADDRESS):
-      self.device = I2cDevice(address)
+   def __init__(self, address=ADDRESS, bus=None, stats=None):
+      self.device = I2cDevice(address, bus=bus, stats=stats)
 
       self.write(0x03)
       self.write(0x03)
@@ -95,6 +124,7 @@ class Lcd(object):
       self.write(LCD_DISPLAYCONTROL | LCD_DISPLAYON)
       self.write(LCD_CLEARDISPLAY)
       self.write(LCD_ENTRYMODESET | LCD_ENTRYLEFT)
+      self._forget(cleared=True)
 
       sleep(0.05)
 
@@ -108,7 +138,46 @@ class Lcd(object):
       self.write(LCD_DISPLAYCONTROL | LCD_DISPLAYON)
       self.write(LCD_CLEARDISPLAY)
       self.write(LCD_ENTRYMODESET | LCD_ENTRYLEFT)
-      
+      self._forget(cleared=True)
+
+   # Reset the shadow copy of DDRAM: blank if the display was just
+   # cleared, otherwise unknown.  The shadow lets display_string send
+   # only the characters that actually changed.
+   def _forget(self, cleared=False):
+      if cleared:
+         self._ddram = dict.fromkeys(list(range(0x00, 0x28)) +
+                                     list(range(0x40, 0x68)), 0x20)
+         self._address = 0x00
+      else:
+         self._ddram = {}
+         self._address = None
+
+   # the port bytes that clock one byte into the lcd, as write() does
+   def _encode(self, value, mode=0):
+      out = []
+      for bits in (mode | (value & 0xF0), mode | ((value << 4) & 0xF0)):
+         out.append(bits | LCD_BACKLIGHT)
+         out.append(bits | En | LCD_BACKLIGHT)
+         out.append((bits & ~En) | LCD_BACKLIGHT)
+      return out
+
+   # write the characters of `string` that differ from the shadow,
+   # starting at DDRAM `address`, in one batch of I2C transactions
+   def _write_at(self, string, address):
+      out = []
+      for offset, char in enumerate(string):
+         pos = address + offset
+         code = ord(char)
+         if self._ddram.get(pos) == code:
+            continue
+         if self._address != pos:
+            out.extend(self._encode(LCD_SETDDRAMADDR | pos))
+         out.extend(self._encode(code, Rs))
+         self._ddram[pos] = code
+         self._address = pos + 1
+      if out:
+         self.device.write_bytes(out)
+
    # clocks EN to latch command
    def strobe(self, data):
       self.device.write_cmd(data | En | LCD_BACKLIGHT)
@@ -129,24 +198,15 @@ class Lcd(object):
       self.write_four_bits(mode | (charvalue & 0xF0))
       self.write_four_bits(mode | ((charvalue << 4) & 0xF0))
   
-   # put string function
+   # put string function; only changed characters are sent
    def display_string(self, string, line):
-      if line == 1:
-         self.write(0x80)
-      if line == 2:
-         self.write(0xC0)
-      if line == 3:
-         self.write(0x94)
-      if line == 4:
-         self.write(0xD4)
-
-      for char in string:
-         self.write(ord(char), Rs)
+      self._write_at(string, LINE_ADDRESSES[line])
 
    # clear lcd and set to home
    def clear(self):
       self.write(LCD_CLEARDISPLAY)
       self.write(LCD_RETURNHOME)
+      self._forget(cleared=True)
 
    # define backlight on/off (lcd.backlight(1); off= lcd.backlight(0)
    def backlight(self, state): # for state, 1 = on, 0 = off
@@ -161,33 +221,15 @@ class Lcd(object):
       for char in fontdata:
          for line in char:
             self.write_char(line)
+      self._address = None # now pointing into CGRAM
 
    def show_cursor(self, line, pos):
-      if line == 1:
-         pos_new = pos
-      elif line == 2:
-         pos_new = 0x40 + pos
-      elif line == 3:
-         pos_new = 0x14 + pos
-      elif line == 4:
-         pos_new = 0x54 + pos
-
-      self.write(0x80 + pos_new)
-
-      self.write(0x0E)
+      pos_new = LINE_ADDRESSES[line] + pos
+
+      self.device.write_bytes(self._encode(0x80 + pos_new) +
+                              self._encode(0x0E))
+      self._address = pos_new
          
    # define precise positioning (addition from the forum)
    def display_string_pos(self, string, line, pos):
-      if line == 1:
-         pos_new = pos
-      elif line == 2:
-         pos_new = 0x40 + pos
-      elif line == 3:
-         pos_new = 0x14 + pos
-      elif line == 4:
-         pos_new = 0x54 + pos
-
-      self.write(0x80 + pos_new)
-
-      for char in string:
-         self.write(ord(char), Rs)
+      self._write_at(string, LINE_ADDRESSES[line] + pos)
@@ -14,15 +14,33 @@ def keyboards():
 
 class KeyReader(object):
     """Reads key events in an endless loop, calling the handler for
-    each one."""
+    each one.  `device_fn` is the path of an input device, or an
+    already-open device object (such as a fakes.FakeInputDevice)."""
     def __init__(self, device_fn):
-        self._device = InputDevice(device_fn)
+        if isinstance(device_fn, str):
+            self._device = InputDevice(device_fn)
+        else:
+            self._device = device_fn
     def event_loop(self, handler):
+        """Call handler(code, value) with the raw evdev key code and state
+        (0 up, 1 down, 2 held) of each key event."""
         for event in self._device.read_loop():
             if event.type == ecodes.EV_KEY:
-                cat = categorize(event)
-                handler(cat.keycode,
-                        cat.keystate)
+                handler(event.code, event.value)
+
+    def fileno(self):
+        return self._device.fileno()
+
+    def read_events(self, handler):
+        """Like event_loop, but only handles the events already waiting,
+        for use with select()."""
+        try:
+            events = list(self._device.read())
+        except BlockingIOError:
+            return
+        for event in events:
+            if event.type == ecodes.EV_KEY:
+                handler(event.code, event.value)
 
 
 class ExclusiveKeyReader(KeyReader):
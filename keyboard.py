@@ -56,8 +56,8 @@ else:
     display_thread.daemon = True
     display_thread.start()
     
-    def feed_fn(asc):
-        os.write(fd, bytes(chr(asc), "utf-8"))
+    def feed_fn(data):
+        os.write(fd, data)
 
     with ExclusiveKeyReader("/dev/input/event1") as key_reader:
         key_handler = KeyHandler(key_reader, feed_fn)
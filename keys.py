@@ -1,4 +1,6 @@
 from copy import copy
+import json
+from evdev import ecodes
 
 _alphabet = "abcdefghijklmnopqrstuvwxyz"
 
@@ -91,82 +93,143 @@ _buckies = {"KEY_RIGHTALT": "A",
            "KEY_RIGHTMETA": "M",
            "KEY_COMPOSE": "P"}
 
+# each bucky as a bit in a modifier mask
+_bucky_bits = {"S": 1, "C": 2, "M": 4, "P": 8, "A": 16}
+ALT = _bucky_bits["A"]
+
 UP=0
 DOWN=1
 HOLD=2
 
+def parse_key(name):
+    """Turn a key name with bucky prefixes, e.g. "S-C-KEY_X", into an
+    (evdev key code, modifier mask) pair."""
+    parts = name.split("-")
+    mods = 0
+    for abbrev in parts[:-1]:
+        mods |= _bucky_bits[abbrev]
+    return ecodes.ecodes[parts[-1]], mods
+
+def key_bytes(value):
+    """The UTF-8 bytes to send for a keymap value: a character code, a
+    list of them, or a string."""
+    if isinstance(value, int):
+        return chr(value).encode("utf-8")
+    elif isinstance(value, str):
+        return value.encode("utf-8")
+    return b"".join(chr(code).encode("utf-8") for code in value)
+
+def compile_keymap(keymap):
+    """Turn a keymap of names to values, like _key_assoc, into a table of
+    (key code, modifier mask) to bytes.  Names evdev doesn't know (such
+    as KEY_RETURN, which no keyboard sends), and values that aren't
+    characters, are left out."""
+    table = {}
+    for name, value in keymap.items():
+        try:
+            table[parse_key(name)] = key_bytes(value)
+        except (KeyError, ValueError, TypeError, OverflowError):
+            pass
+    return table
+
+def load_keymap(path):
+    """Read a keymap from a JSON file of key names to values, e.g.
+    {"C-KEY_H": 8, "M-KEY_E": "\u20ac"}, to override the defaults."""
+    with open(path) as f:
+        return json.load(f)
+
 class KeyHandler(object):    
-    def __init__(self, keyreader, receiver):
+    """Turns key events from `keyreader` into the bytes a terminal would
+    send, handing each keypress to `receiver` as one bytes object.
+    `actions` maps key names, with their bucky prefix (e.g.
+    "S-KEY_PAGEUP"), to functions called instead of sending anything.
+    Entries in `keymap` add to or override the default key bindings.
+
+    The keymap is compiled once into a table keyed by raw evdev key
+    code and a bitmask of the buckies held, so handling a key is a
+    single lookup.
+
+    """
+    def __init__(self, keyreader, receiver, actions=None, keymap=None):
         self.keyreader = keyreader
         self.receiver = receiver
-        self.alt = False
-        self.buckies = []
+
+        assoc = dict(_key_assoc)
+        assoc.update(keymap or {})
+        self.table = compile_keymap(assoc)
+        self.actions = dict((parse_key(name), action)
+                            for name, action in (actions or {}).items())
+
+        self.bucky_keys = dict((ecodes.ecodes[name], _bucky_bits[abbrev])
+                               for name, abbrev in _buckies.items())
+        self.held = {} # bucky key code -> bit, while held down
+        self.mods = 0
+
     def bucky_set(self):
-        """Return a dash-delimited alphabetized list of unique buckies that
-        are currently on (except for ALT, which is handled
-        differently), followed by a trailing dash, e.g. "S-M-C-".  If
-        no buckies are on, return an empty string.
+        """Return a dash-delimited list of the buckies that are currently
+        on, followed by a trailing dash, e.g. "S-M-C-".  If no buckies
+        are on, return an empty string.
 
         """
-        if self.buckies:
-                return "-".join(sorted(set(self.buckies), reverse=True)) + "-"
-        else:
-            return ""
-        
-    def handle_bucky(self, keycode, keystate):
+        return "".join(abbrev + "-"
+                       for abbrev in sorted(_bucky_bits, reverse=True)
+                       if self.mods & _bucky_bits[abbrev])
 
-        if keycode in ["KEY_LEFTALT",
-                       "KEY_RIGHTALT"]:
-            self.alt = keystate in [DOWN, HOLD]
-            return True
-        
+    def handle_bucky(self, code, keystate):
         # if it's not a bucky, get out
         try:
-            abbrev = _buckies[keycode]
+            bit = self.bucky_keys[code]
         except KeyError:
             return False
 
         # while it's down, keep a record of it
-        if keystate == DOWN:
-            self.buckies.append(abbrev)
-        elif keystate == UP:
-            bucky = _buckies[keycode]
-            while bucky in self.buckies:
-                self.buckies.remove(bucky)
+        if keystate == UP:
+            self.held.pop(code, None)
+        else:
+            self.held[code] = bit
+        mods = 0
+        for bit in self.held.values():
+            mods |= bit
+        self.mods = mods
 
         return True
 
-    def maybe_send_alt(self):
-        if self.alt:
-            self.receiver(control_codes["ESC"])
-
-    def handle_nonbucky(self, keycode, keystate):
-        if keystate in [DOWN, HOLD]:
-            alt_code = self.bucky_set() + keycode
-            try:
-                char = _key_assoc[alt_code]
-            except KeyError:
-                return False
-            self.maybe_send_alt()
-            if type(char) == list:
-                for c in char:
-                    self.receiver(c)
-            else:
-                self.receiver(char)
+    def handle_nonbucky(self, code, keystate):
+        if keystate not in (DOWN, HOLD):
+            return False
+
+        key = (code, self.mods)
+        if key in self.actions:
+            self.actions[key]()
             return True
-        else:
-            return False    
 
-    def handle_key(self, keycode, keystate):
-        if self.handle_bucky(keycode, keystate):
+        # alt either has a binding of its own, or sends ESC first
+        data = self.table.get(key)
+        if data is None and self.mods & ALT:
+            data = self.table.get((code, self.mods & ~ALT))
+            if data is not None:
+                data = b"\x1b" + data
+        if data is None:
+            return False
+
+        self.receiver(data)
+        return True
+
+    def handle_key(self, code, keystate):
+        if self.handle_bucky(code, keystate):
             pass
-        elif self.handle_nonbucky(keycode, keystate):
+        elif self.handle_nonbucky(code, keystate):
             pass
-        else:
-            if keycode == "KEY_F1":
-                exit()
-            elif keystate == DOWN:
-                print(keycode, self.bucky_set())
+        elif keystate == DOWN:
+            if code == ecodes.KEY_F1:
+                self.quit()
+            else:
+                print(ecodes.KEY.get(code, code), self.bucky_set())
+
+    def quit(self):
+        """F1, with nothing bound to it, quits."""
+        exit()
+
     def run(self):
         self.keyreader.event_loop(self.handle_key)
 
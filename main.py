@@ -1,16 +1,35 @@
 import os
-import pty
-from threading import Thread
+import select
+import selectors
+from threading import Thread, Condition, Lock, Event
+from collections import namedtuple
 from datetime import datetime, timedelta
 import time
-import pyte
+from array import array
 
+from cellscreen import BOLD, REVERSE, attr_word, code_text
 from key_events import ExclusiveKeyReader
-from keys import KeyHandler
+from keys import KeyHandler, load_keymap
 import pervasive
-from pil2epd import convert
-from PIL import Image, ImageFont, ImageDraw
-from fontlist import FontList
+from scheduler import RefreshScheduler
+from session import Session
+from stats import Stats
+
+# an immutable view of the emulated screen, as handed to renderers:
+# `rows` holds a (codes, attribute words) pair of arrays per row (see
+# cellscreen), `dirty` the rows changed
+# since the generation the caller asked about, and `cursor` is (x, y)
+ScreenSnapshot = namedtuple("ScreenSnapshot",
+                            ["generation", "rows", "dirty", "cursor"])
+
+# seconds over which bash's output rate is measured for flood detection
+FLOOD_WINDOW = 0.5
+
+# seconds between reads of a session that isn't on show
+BACKGROUND_INTERVAL = 0.25
+
+# pixels left blank down the left edge of the landscape screen
+LEFT_MARGIN = 14
 
 class PaperTerm(ExclusiveKeyReader):
     """Runs an in-memory instance of bash, communicating with an in-memory
@@ -19,6 +38,57 @@ class PaperTerm(ExclusiveKeyReader):
     and printed to the initiating terminal, slowing display
     considerably..
 
+    `keyboard` may be a device path or an open device object.  The
+    e-paper display and the LCD's I2C bus can be passed in as
+    `display` and `lcd_bus` (see `fakes` for simulated ones), and
+    `font_path` skips the search for Roboto Mono.  `scheduler` decides
+    when the panel refreshes; see scheduler.RefreshScheduler.
+
+    When bash writes faster than `flood_rate` bytes a second (`yes`,
+    `cat` of a big log), the terminal goes into flood mode: renderers
+    are only woken once per FLOOD_WINDOW rather than per read, and the
+    panel shows a frame only when the scheduler's staleness deadline
+    forces one.  With `flood_backpressure`, bash's output also stops
+    being read once `flood_backlog` bytes have gone unshown, until the
+    next frame is taken; bash then blocks on its own writes, leaving
+    the CPU free and Ctrl-C prompt.
+
+    Rows scrolling off the top are kept in a Scrollback of
+    `scrollback_bytes`, in memory or mapped from `scrollback_file`, and
+    paged through on the e-paper with Shift-PageUp and Shift-PageDown.
+    Key bindings can be added to or overridden from the JSON file
+    `keymap_file`; see keys.load_keymap.
+
+    Alt-F1 to Alt-F9 switch between up to nine sessions, each its own
+    bash, starting one the first time its key is pressed.  Only the
+    session on show is drawn; the others are still read and parsed,
+    but in batches a few times a second and without waking the
+    renderers, and they share the scrollback budget between them.
+
+    By default bash, the keyboard, the LCD and the e-paper each get a
+    thread; with `event_loop`, they are all multiplexed in the thread
+    that calls `start` instead.  With `display_process`, the panel is
+    driven from a process of its own (see remote_display), so uploads
+    run on another core and a hung panel can be restarted without the
+    terminal stalling.
+
+    Starting up, the display, the LCD and the font are all brought up
+    in parallel while bash starts; the path of the font found for
+    `font_path` None, and its cell size, are cached on disk (see
+    fontcache).  `startup` records when each stage finished.
+
+    Every stage of the pipeline is timed, and bytes and frames
+    counted, in `stats` (see stats.Stats), which is written to
+    `stats_file` every `stats_interval` seconds and/or served on the
+    Unix socket `stats_socket`.
+
+    With `trace_file`, bash's output and the key events are recorded
+    there, to be replayed offline; see ptytrace.
+
+    Should the screen change while a frame is being uploaded, the
+    upload starts over with the new one, up to `upload_restarts` times
+    a frame, rather than refresh the panel with what is already stale.
+
     """
     def __init__(self,
                  keyboard,
@@ -26,172 +96,803 @@ class PaperTerm(ExclusiveKeyReader):
                  rows=24,
                  cols=80,
                  debug=False,
-                 use_lcd=False):
-        
+                 use_lcd=False,
+                 display=None,
+                 lcd_bus=None,
+                 font_path=None,
+                 scheduler=None,
+                 flood_rate=65536,
+                 flood_backpressure=False,
+                 flood_backlog=262144,
+                 scrollback_bytes=262144,
+                 scrollback_file=None,
+                 keymap_file=None,
+                 event_loop=False,
+                 display_process=False,
+                 stats=None,
+                 stats_file=None,
+                 stats_socket=None,
+                 stats_interval=5.0,
+                 trace_file=None,
+                 upload_restarts=3):
+
+        # seconds from here until each stage of startup was done
+        self._created = time.monotonic()
+        self.startup = {}
+
         ExclusiveKeyReader.__init__(self, keyboard)
         
         self.cols = cols
         self.rows = rows
         
-        # set up an in-memory screen and its communication stream
-        self.screen = pyte.Screen(cols, rows)
-        self.stream = pyte.Stream()
-        self.stream.attach(self.screen)
-
-        self.display = pervasive.PervasiveDisplay()
+        # the first session, whose bash is started by `start`; the one
+        # on show is `self.session`
+        self.scrollback_bytes = scrollback_bytes
+        self.scrollback_file = scrollback_file
+        self.session = Session(1, cols, rows, scrollback_bytes, scrollback_file)
+        self.sessions = {1: self.session}
+
+        # the display, the LCD and the font are set up by `start`
+        self.display = display
+        self.display_process = display_process
+        self.font_path = font_path
+        self.lcd_bus = lcd_bus
         
         self.debug = debug
 
         self.use_lcd = use_lcd
 
+        self.keymap = load_keymap(keymap_file) if keymap_file else None
+        self.use_event_loop = event_loop
+
         os.environ["COLUMNS"] = "%s" % cols
         os.environ["LINES"] = "%s" % rows
 
-        self.last_keypress = datetime.fromordinal(1)
-        
-        try:
-            fonts = FontList.all().by_partial_name("roboto mono").bold()
-            font = [font for font in fonts
-                    if font not in fonts.slanted()][0]
-        except IndexError:
-            raise Exception("You must install the Roboto Mono font.")
-
-        self.font = ImageFont.truetype(font["path"], size=15)
-
-    def _ready_for_screen_update(self):
-        """Determine if the user has stopped typing for a bit; if so, say yes
-        to a screen redraw."""
-        if (datetime.now() - self.last_keypress).total_seconds() > 0.5:
-            return True
+        if scheduler is None:
+            scheduler = RefreshScheduler()
+        self.scheduler = scheduler
+
+        self.stats = stats if stats is not None else Stats()
+        self.stats_file = stats_file
+        self.stats_socket = stats_socket
+        self.stats_interval = stats_interval
+
+        if trace_file:
+            from ptytrace import TraceWriter
+            self.trace = TraceWriter(trace_file, rows, cols)
         else:
+            self.trace = None
+
+        # bumped and signalled whenever the emulated screen or the
+        # keyboard changes, so the renderers can sleep until then
+        self._changed = Condition()
+        self._generation = 0
+
+        # held while pyte is fed, while snapshot() copies rows, and while
+        # sessions are switched; the copies are kept, with the screen
+        # generation they were made at, and only rows pyte has marked
+        # dirty are copied again
+        self._screen_lock = Lock()
+        self._screen_generation = 0
+        self._rows = [()] * rows
+        self._row_generation = [-1] * rows
+
+        # flood detection, and the bytes fed since the display last
+        # took a snapshot to draw, for backpressure
+        self.flood_rate = flood_rate
+        self.flood_backpressure = flood_backpressure
+        self.flood_backlog = flood_backlog
+        self._flood = False
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+        self._last_output = 0
+        self._unshown = 0
+        self._frame_taken = Event()
+
+        # e-paper renderer state: rows waiting to be redrawn (all of
+        # them, for the first frame), where the cursor box was drawn,
+        # and the screen generation last drawn from
+        self._display_pending = set(range(rows))
+        self._display_cursor = (None, None)
+        self._display_since = None
+        self.upload_restarts = upload_restarts
+        self._restarts = 0 # of the frame going up
+
+        # how many rows back into the scrollback the e-paper shows
+        self.scroll_offset = 0
+        self._view_changed = False
+
+    def _mark(self, stage):
+        """Note that a stage of startup is done, the first time only."""
+        if stage not in self.startup:
+            self.startup[stage] = time.monotonic() - self._created
+
+    def startup_report(self):
+        """Say how long after the terminal was created each stage of
+        startup was done."""
+        return ", ".join("%s %.3fs" % (stage, seconds) for stage, seconds
+                         in sorted(self.startup.items(),
+                                   key=lambda item: item[1]))
+
+    def _init_font(self, size=15):
+        from PIL import ImageFont
+        from glyphs import GlyphAtlas
+        from epd_frame import EpdFrame, WIDTH, HEIGHT
+        import fontcache
+
+        path = self.font_path or fontcache.find_font()
+        self.font = ImageFont.truetype(path, size=size)
+
+        # the panel is mounted landscape, HEIGHT pixels across and WIDTH
+        # down; rather than run the grid off it, a font too big for it
+        # is drawn at a tighter pitch, its cells cropped
+        width, height = fontcache.cell_size(self.font, path, size)
+        width = min(width, (HEIGHT - LEFT_MARGIN) // self.cols)
+        height = min(height, WIDTH // self.rows)
+        if not width or not height:
+            raise ValueError("%d x %d characters don't fit on the panel"
+                             % (self.cols, self.rows))
+
+        # persistent framebuffer in the panel's layout, and glyph cells
+        # pre-rotated to be copied straight into it
+        self.frame = EpdFrame()
+        self.glyphs = GlyphAtlas(self.font, prepare=self.frame.prepare,
+                                 cell_size=(width, height))
+        self._mark("font")
+
+    def _init_display(self):
+        if self.display is None:
+            # clocked as fast as this panel was found to take reliably
+            from spi_calibration import calibrated_display
+            if self.display_process:
+                from remote_display import RemoteDisplay
+                self.display = RemoteDisplay(calibrated_display,
+                                             stats=self.stats)
+            else:
+                self.display = calibrated_display(stats=self.stats)
+        self._mark("display")
+
+    def _init_hardware(self):
+        """Bring up the display, the LCD and the font side by side, each
+        mostly waiting on a bus, a sleep or the disk; return once all are
+        ready, raising the first error any of them hit."""
+        steps = [self._init_display, self._init_font]
+        if self.use_lcd:
+            steps.append(self._init_lcd)
+
+        errors = []
+        def run(step):
+            try:
+                step()
+            except BaseException as e:
+                errors.append(e)
+
+        threads = [Thread(target=run, args=(step,)) for step in steps]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    # the session on show's emulator, scrollback and PTY
+    @property
+    def screen(self):
+        return self.session.screen
+
+    @property
+    def stream(self):
+        return self.session.stream
+
+    @property
+    def scrollback(self):
+        return self.session.scrollback
+
+    @property
+    def bash_fd(self):
+        return self.session.fd
+
+    def _start_reader(self, session):
+        """Start a thread reading `session`'s bash."""
+        thread = Thread(target=self._read_bash, args=(session,))
+        thread.daemon = True # die if main thread ends
+        thread.start()
+        return thread
+
+    def _share_scrollback(self):
+        """Split the scrollback budget evenly between the sessions."""
+        if not self.sessions:
+            return
+        budget = self.scrollback_bytes // len(self.sessions)
+        with self._screen_lock:
+            for session in self.sessions.values():
+                session.scrollback.resize(budget)
+
+    def _open_session(self, number):
+        """Start bash in a new session, numbered `number`."""
+        spill = self.scrollback_file
+        if spill:
+            spill = "%s.%d" % (spill, number)
+        session = Session(number, self.cols, self.rows,
+                          self.scrollback_bytes // (len(self.sessions) + 1),
+                          spill)
+        session.spawn()
+        with self._screen_lock:
+            self.sessions[number] = session
+        self._share_scrollback()
+        if not self.use_event_loop:
+            self._start_reader(session)
+        return session
+
+    def _close_session(self, session):
+        """Forget a session whose bash has exited, showing another in its
+        place if it was on show."""
+        with self._screen_lock:
+            self.sessions.pop(session.number, None)
+        session.close()
+        if session is self.session and self.sessions:
+            self.switch_session(min(self.sessions))
+        self._share_scrollback()
+
+    def switch_session(self, number):
+        """Show session `number`, starting it if it isn't running yet.  The
+        whole screen is redrawn from the new session, in one frame."""
+        session = self.sessions.get(number)
+        if session is None:
+            session = self._open_session(number)
+        if session is self.session:
+            return
+
+        with self._screen_lock:
+            self.session = session
+            session.screen.dirty.update(range(self.rows))
+            self._screen_generation += 1
+        self._unshown = 0
+        self.scroll_offset = 0
+        self._view_changed = True
+        self._notify_change()
+
+    def _notify_change(self, keypress=False):
+        """Tell the scheduler about a screen change (or just a keypress),
+        and wake every renderer waiting in `_wait_for_change`."""
+        if keypress:
+            self.scheduler.note_input()
+        else:
+            self.scheduler.note_change()
+        with self._changed:
+            self._generation += 1
+            self._changed.notify_all()
+
+    def _wait_for_change(self, seen, timeout=None):
+        """Block until something has changed since generation `seen`, or
+        until `timeout` seconds have passed, and return the current
+        generation.
+
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: self._generation != seen, timeout)
+            return self._generation
+
+    def _read_bash(self, session, batch_size=65536):
+        """To be run in a separate thread, reading from a session's Bash
+        process and feeding its VT102 emulator.  Whatever output is
+        already waiting is drained, up to `batch_size` bytes, and fed in
+        one go; UTF-8 sequences split between reads are carried over to
+        the next.
+
+        """
+        while self._read_output(session, batch_size):
+            if session is not self.session:
+                # in the background: let output pile up between reads
+                time.sleep(BACKGROUND_INTERVAL)
+            elif self._too_far_behind():
+                # too far behind: let the kernel's buffer fill up until
+                # the display takes a frame (waking now and then only to
+                # notice a switch to another session)
+                while True:
+                    self._frame_taken.clear()
+                    if (session is not self.session or
+                            not self._too_far_behind()):
+                        break
+                    self._frame_taken.wait(FLOOD_WINDOW)
+        self._close_session(session)
+
+    def _read_output(self, session, batch_size=65536):
+        """Read from a session's bash once, plus whatever else is already
+        waiting (up to `batch_size` bytes), and feed it all to the
+        emulator.  Only output from the session on show wakes the
+        renderers.  Return False once bash has gone away.
+
+        """
+        fd = session.fd
+        try:
+            out = os.read(fd, 4096)
+        except OSError:
+            return False # if there's nothing to read, stop reading
+        if not out:
             return False
 
-    def _read_bash(self):
-        """To be run in a separate thread, reading from the Bash process and
-        feeding the VT102 emulator.
+        chunks, size = [out], len(out)
+        try:
+            while (size < batch_size and
+                   select.select([fd], [], [], 0)[0]):
+                more = os.read(fd, 4096)
+                if not more:
+                    break
+                chunks.append(more)
+                size += len(more)
+        except OSError:
+            pass # feed what we have; the next read will notice
+
+        self._feed_output(session, b"".join(chunks))
+        return True
+
+    def _feed_output(self, session, data):
+        """Feed output from a session's bash to its emulator, waking the
+        renderers if it is the session on show."""
+        if self.trace:
+            self.trace.output(session.number, data)
+
+        size = len(data)
+        stats = self.stats
+        with self._screen_lock:
+            start = stats.clock()
+            session.feed(data)
+            stats.record("feed", stats.clock() - start)
+            shown = session is self.session
+            if shown:
+                self._screen_generation += 1
+        stats.add("bytes_parsed", size)
+        if shown and "output" not in self.startup:
+            self._mark("output")
+        if shown and self._note_output(size):
+            self._notify_change()
+
+    def _too_far_behind(self):
+        """Whether backpressure says to stop reading bash for now: until
+        the display takes a frame, which resets `_unshown`."""
+        return (self.flood_backpressure and self._flood and
+                self._unshown > self.flood_backlog)
+
+    def _note_output(self, size):
+        """Account for `size` bytes of output from bash, updating flood
+        mode, and say whether the renderers should be woken for it.
 
         """
-        while True:
-            try:
-                out = os.read(self.bash_fd, 4096)
-                try:
-                    self.stream.feed(out.decode("utf-8"))
-                except UnicodeDecodeError:
-                    pass  # at least don't die if there's weird input
-            except OSError:
-                break # if there's nothing to read, kill the reader
-                      # thread
+        now = time.monotonic()
+        self._last_output = now
+        self._window_bytes += size
+        self._unshown += size
+
+        elapsed = now - self._window_start
+        if elapsed < FLOOD_WINDOW:
+            return not self._flood
+
+        rate = self._window_bytes / elapsed
+        if self._flood:
+            self._flood = rate > self.flood_rate / 2
+        else:
+            self._flood = rate > self.flood_rate
+        if self.debug and self._flood:
+            print("flood mode: %d bytes/s" % rate)
+        self._window_start, self._window_bytes = now, 0
+        return True
+
+    @property
+    def flooding(self):
+        """True while bash's output is flooding in, or held back by
+        backpressure, which stops it arriving."""
+        return self._flood and (
+            time.monotonic() - self._last_output < FLOOD_WINDOW or
+            self._too_far_behind())
+
+    def snapshot(self, since=None):
+        """Return a ScreenSnapshot of the emulated screen, whose `dirty`
+        holds the rows changed since generation `since` (every row, if
+        None).  Pass each snapshot's generation back in as `since` to
+        get just the changes in between.
 
-    def _write_lcd(self):
+        """
+        with self._screen_lock:
+            generation = self._screen_generation
+            screen = self.screen
+            for y in screen.dirty:
+                self._rows[y] = screen.copy_row(y)
+                self._row_generation[y] = generation
+            screen.dirty.clear()
+            rows = tuple(self._rows)
+            cursor = (screen.cursor.x, screen.cursor.y)
+
+        if since is None:
+            dirty = frozenset(range(self.rows))
+        else:
+            dirty = frozenset(y for y, row_generation
+                              in enumerate(self._row_generation)
+                              if row_generation > since)
+        return ScreenSnapshot(generation, rows, dirty, cursor)
+
+    def scroll(self, pages):
+        """Page the e-paper view back through the scrollback (positive
+        `pages`) or forward again (negative)."""
+        with self._screen_lock:
+            history = len(self.scrollback)
+        offset = max(0, min(self.scroll_offset + pages * self.rows, history))
+        if offset != self.scroll_offset:
+            self.scroll_offset = offset
+            self._view_changed = True
+            self._notify_change()
+
+    def _scrolled_rows(self, rows, offset):
+        """Return the rows of a snapshot as seen `offset` rows back into
+        the scrollback."""
+        with self._screen_lock:
+            first = len(self.scrollback) - offset
+            history = self.scrollback.rows(first, first + self.rows)
+        blank = array("I", [attr_word(self.screen.default_char)]) * self.cols
+        view = [((codes + array("I", [32]) * self.cols)[:self.cols], blank)
+                for codes in history]
+        return tuple(view) + rows[:self.rows - len(view)]
+
+    def _lcd_text(self, row, start, end):
+        """Return columns `start` to `end` of a snapshot row, with anything
+        the LCD can't show as a space."""
+        return "".join(chr(code) if 32 <= code < 127 else " "
+                       for code in row[0][start:end])
+
+    def _init_lcd(self):
         from i2c_lcd import Lcd
 
-        self.lcd = Lcd()
+        self.lcd = Lcd(bus=self.lcd_bus, stats=self.stats)
         # previous values, allowing us to wait for change before
         # displaying
-        prev_screen = ""
-        prev_x, prev_y = 100, 100 # off the screen
-        last_draw_time = datetime.now()
+        self._lcd_shown = ("", 100, 100) # off the screen
+        self._lcd_last_draw = datetime.now()
+        self._lcd_lit = True
+        self._mark("lcd")
+
+    def _update_lcd(self, lcd_width=40, backlight_timeout=5):
+        """One pass of the LCD mirror: redraw it if the two rows around the
+        cursor, or the cursor, have changed, and turn the backlight off
+        once idle.  Returns the seconds until it's worth looking again,
+        or None to wait for a change.
+
+        """
+        if self.flooding:
+            # look again once the flood has passed
+            return FLOOD_WINDOW
+
+        snap = self.snapshot()
+        scrn_x, scrn_y = snap.cursor
+
+        # draw to LCD
+        start_x, end_x = scrn_x - 20, scrn_x + 20
+        if start_x < 0:
+            start_x, end_x = 0, end_x - start_x
+        elif end_x > self.cols:
+            start_x, end_x = self.cols - lcd_width, self.cols
+
+        # only the two rows around the cursor are ever shown
+        top = 0 if scrn_y == 0 else scrn_y - 1
+        l1 = self._lcd_text(snap.rows[top], start_x, end_x)
+        l2 = (self._lcd_text(snap.rows[top + 1], start_x, end_x)
+              if top + 1 < self.rows else "")
+
+        # if the display or cursor position has changed, redraw
+        shown = (l1 + "\n" + l2, scrn_x, scrn_y)
+        if shown != self._lcd_shown:
+            start = self.stats.clock()
+            if not self._lcd_lit:
+                self.lcd.backlight(1)
+
+            self.lcd.display_string(l1.ljust(lcd_width), 1)
+            self.lcd.display_string(l2.ljust(lcd_width), 2)
 
-        draw_num = 0
+            if scrn_y == 0:
+                self.lcd.show_cursor(1, scrn_x - start_x)
+            else:
+                self.lcd.show_cursor(2, scrn_x - start_x)
 
+            self._lcd_shown = shown
+            self._lcd_last_draw = datetime.now()
+            self._lcd_lit = True
+            self.stats.record("lcd", self.stats.clock() - start)
+
+        if not self._lcd_lit:
+            return None
+        idle = (datetime.now() - self._lcd_last_draw).total_seconds()
+        if idle > backlight_timeout:
+            self.lcd.backlight(0)
+            self._lcd_lit = False
+            return None
+        return backlight_timeout - idle
+
+    def _write_lcd(self):
+        """To be run in a separate thread, mirroring the area around the
+        cursor on the LCD."""
+        seen = None
+        timeout = None
         while True:
-            s = self.screen.display
-            scrn_x, scrn_y = self.screen.cursor.x, self.screen.cursor.y
+            # sleep until the screen changes, or the backlight is due off
+            seen = self._wait_for_change(seen, timeout)
+            timeout = self._update_lcd()
 
-            s = ["".join([c for c in line
-                          if ord(c) < 127])
-                 for line in s]
-            
-            # draw to LCD
-            lcd_width = 40
+    def _render_frame(self, left=LEFT_MARGIN):
+        """One pass of the e-paper renderer.  Take a snapshot, and if the
+        scheduler says a refresh is due, draw the rows that changed since
+        the last frame (plus the rows the cursor leaves and enters) into
+        the persistent framebuffer.
 
-            start_x, end_x = scrn_x - 20, scrn_x + 20
-            if start_x < 0:
-                start_x, end_x = 0, end_x - start_x
-            elif end_x > self.cols:
-                start_x, end_x = self.cols - lcd_width, self.cols
+        Returns (True, None) when `self.frame` is ready to upload, or
+        (False, timeout) with the seconds until it's worth looking again
+        (None: not until something changes).
+
+        """
+        scheduler, pending = self.scheduler, self._display_pending
+
+        if self.flooding:
+            # skip the intermediate states; draw only when the
+            # scheduler's staleness deadline insists
+            if not scheduler.pending:
+                scheduler.note_change()
+            # a lull in the output is no reason to draw: it may only
+            # be backpressure holding it back
+            timeout = scheduler.delay(debounce=False)
+            if timeout > 0:
+                scheduler.skip()
+                self.stats.add("frames_skipped")
+                return False, min(timeout, FLOOD_WINDOW)
+
+        snap, offset = self._take_changes()
+        if not pending:
+            scheduler.drop()
+            self.stats.add("frames_dropped")
+            # the output so far changed nothing: nothing to catch up on
+            self._unshown = 0
+            self._frame_taken.set()
+            return False, None
+        if not scheduler.pending:
+            scheduler.note_change()
+
+        timeout = scheduler.delay()
+        if timeout > 0:
+            return False, timeout
+        scheduler.begin()
+        self._restarts = 0
+        self._draw(snap, offset, left)
+        return True, None
+
+    def _take_changes(self):
+        """Take a snapshot, adding the rows changed since the last one to
+        those waiting to be redrawn, along with the rows the cursor
+        leaves and enters (or every row, if the view is scrolled).
+        Returns the snapshot, and the scroll offset it is seen at.
+
+        """
+        pending = self._display_pending
+        snap = self.snapshot(self._display_since)
+        self._display_since = snap.generation
+        pending.update(snap.dirty)
+
+        offset = self.scroll_offset
+        if offset or self._view_changed:
+            # the whole view moves when scrolled
+            self._view_changed = False
+            pending.update(range(self.rows))
+
+        scrn_x, scrn_y = snap.cursor
+        prev_x, prev_y = self._display_cursor
+        if (prev_x, prev_y) != (scrn_x, scrn_y):
+            # erase the old cursor box and draw the new one
+            if prev_y is not None:
+                pending.add(prev_y)
+            pending.add(min(scrn_y, self.rows - 1))
+        return snap, offset
+
+    def _draw(self, snap, offset, left=LEFT_MARGIN):
+        """Draw the rows waiting to be redrawn, and the cursor, from a
+        snapshot into the framebuffer."""
+        glyphs, frame = self.glyphs, self.frame
+        char_width, row_height = glyphs.cell_width, glyphs.cell_height
+        pending = self._display_pending
+        scrn_x, scrn_y = snap.cursor
+        self._unshown = 0
+        self._frame_taken.set()
+
+        # compose each dirty row from cached cells; every cell
+        # covers its whole box, so nothing needs blanking first
+        start = self.stats.clock()
+        rows = snap.rows
+        if offset:
+            rows = self._scrolled_rows(rows, offset)
+        for y in pending:
+            top = y * row_height
+            codes, attrs = rows[y]
+            for x, code in enumerate(codes):
+                word = attrs[x]
+                frame.blit(glyphs.cell(code_text(code), word & BOLD,
+                                       word & REVERSE),
+                           left + x * char_width, top)
+
+        # keep the box inside the cursor's cell, even when the cursor
+        # sits past the last column, so repainting the row always
+        # erases it
+        if not offset:
+            box_x = min(scrn_x, self.cols - 1) * char_width + left
+            frame.box(box_x, scrn_y * row_height,
+                      box_x + char_width - 1,
+                      scrn_y * row_height + row_height - 1)
+
+        self.stats.record("render", self.stats.clock() - start)
+        self.stats.add("frames_rendered")
+        self.stats.add("rows_rendered", len(pending))
+        pending.clear()
+        self._display_cursor = (scrn_x, scrn_y)
+
+    def _newer_frame(self):
+        """Asked by the display between chunks of an upload: if the screen
+        has changed since the frame going up was drawn, draw it again
+        and return it packed, for the upload to start over with;
+        otherwise None.  Not while output is flooding in, nor more than
+        `upload_restarts` times a frame, lest the panel never refresh.
+
+        """
+        if (self._restarts >= self.upload_restarts or self.flooding or
+                (self._screen_generation == self._display_since and
+                 not self._view_changed)):
+            return None
+        snap, offset = self._take_changes()
+        if not self._display_pending:
+            return None
+        self._restarts += 1
+        self.scheduler.restart()
+        self.stats.add("frames_restarted")
+        self._draw(snap, offset)
+        return self._pack_frame()
+
+    def _pack_frame(self):
+        """The rendered frame, packed for the panel."""
+        start = self.stats.clock()
+        data = self.frame.tobytes()
+        self.stats.record("pack", self.stats.clock() - start)
+        return data
+
+    def _frame_shown(self):
+        """The frame from `_render_frame` has been uploaded and the panel
+        told to refresh."""
+        if self.debug:
+            print("frame uploaded in %.3fs" % self.display.last_upload_time)
+        if "frame" not in self.startup:
+            self._mark("frame")
+            if self.debug:
+                print("startup: %s" % self.startup_report())
+        self.stats.add("frames_shown")
+        self.scheduler.end()
+
+    def _frame_failed(self, error):
+        """The panel failed to show the frame from `_render_frame`; try the
+        whole screen again once the scheduler allows."""
+        if self.debug:
+            print("frame lost: %s" % error)
+        self.stats.add("frames_lost")
+        self.scheduler.end()
+        self._display_pending.update(range(self.rows))
+        self._notify_change()
 
-            try:
-                if scrn_y == 0:
-                    l1, l2 = (s[scrn_y][start_x:end_x],
-                              s[scrn_y + 1][start_x:end_x])
-                else:
-                    l1, l2 = (s[scrn_y - 1][start_x:end_x],
-                              s[scrn_y][start_x:end_x])
-                    
-            except IndexError:
-                pass
-
-            # if the display or cursor position has changed, redraw
-            if (l1 + "\n" + l2 != prev_screen or
-                (prev_x != scrn_x) or
-                (prev_y != scrn_y)):
-                
-                time.sleep(0.1)
-                
-                self.lcd.backlight(1)
-                
-                self.lcd.display_string(l1.ljust(lcd_width), 1)
-                self.lcd.display_string(l2.ljust(lcd_width), 2)
-                
-                if scrn_y == 0:
-                    self.lcd.show_cursor(1, scrn_x - start_x)
-                else:
-                    self.lcd.show_cursor(2, scrn_x - start_x)
-                    
-                time.sleep(0.1)
-                
-                prev_screen = l1 + "\n" + l2
-                prev_x = scrn_x
-                prev_y = scrn_y
-                last_draw_time = datetime.now()
-            elif (datetime.now() - last_draw_time).seconds > 5:
-                self.lcd.backlight(0)
-    
     def _write_display(self):
         """To be run in a separate thread, reading from the VT102 emulator and
-        feeding the serial e-paper display.
+        feeding the serial e-paper display.  If nothing changed, no frame
+        is built at all.
 
         """
+        seen = None
+        timeout = None
+        while True:
+            # sleep until the screen changes, or a refresh comes due
+            seen = self._wait_for_change(seen, timeout)
 
-        # previous values, allowing us to wait for change before
-        # displaying
-        prev_screen = ""
-        prev_x, prev_y = 100, 100 # off the screen
+            ready, timeout = self._render_frame()
+            if ready:
+                try:
+                    self.display.refresh(self._pack_frame(),
+                                         self._newer_frame)
+                except pervasive.DisplayError as e:
+                    self._frame_failed(e)
+                else:
+                    self._frame_shown()
 
-        draw_num = 0
+    def _run_event_loop(self, key_handler, busy_poll=0.01):
+        """Drive bash's PTY, the keyboard, the LCD and the e-paper from this
+        one thread, instead of one thread each.  Uploads to the panel run
+        a command at a time between other work, and input is always
+        handled first, so a keystroke never waits behind a frame.
+        Returns once every session's bash has exited.
+
+        """
+        selector = selectors.DefaultSelector()
+        selector.register(self.fileno(), selectors.EVENT_READ, "keys")
+        reading = set() # sessions whose PTYs are being watched
+
+        upload = None # the refresh in progress, one step per command
+        poll = 0 # how long to sleep while the panel is busy
+        seen = None # screen generation last rendered from
+        display_due = lcd_due = 0 # when to look again; None: on change
 
         while True:
-            s = self.screen.display
-            scrn_x, scrn_y = self.screen.cursor.x, self.screen.cursor.y
-            
-            if (("\n".join(s) != prev_screen) or
-                (prev_x != scrn_x) or
-                (prev_y != scrn_y)) and self._ready_for_screen_update():
-
-                image = Image.new("1", (800, 480), 1)
-
-
-                drawer = ImageDraw.Draw(image)
-                
-                for row_ind in range(len(s)):
-                    drawer.text((14, 18 * row_ind), s[row_ind], font=self.font)
-
-                char_width = 9.0
-                drawer.rectangle([int(scrn_x * char_width + 14), scrn_y * 18,
-                                  int(scrn_x * char_width + 14 + char_width), scrn_y * 18 + 18],
-                                 outline=0)
-                image = image.rotate(270)
-                
-                epd_data = convert(image)
-                self.display.reset_data_pointer()
-                self.display.send_image(epd_data)
-                self.display.update_display()
-                
-                prev_screen = "\n".join(s)
-                prev_x, prev_y = (scrn_x,
-                                  scrn_y)
-                
+            # watch the session on show unless backpressure says to stop,
+            # and the others once their BACKGROUND_INTERVAL is up
+            now = time.monotonic()
+            wanted = set(session for session in self.sessions.values()
+                         if session is not self.session and
+                         session.next_read <= now)
+            if not self._too_far_behind():
+                wanted.add(self.session)
+            for session in reading - wanted:
+                selector.unregister(session.fd)
+            for session in wanted - reading:
+                selector.register(session.fd, selectors.EVENT_READ, session)
+            reading = wanted
+
+            if upload is not None:
+                # most busy spells last well under a millisecond; back
+                # off towards `busy_poll` for the long ones, such as a
+                # refresh
+                if self.display.busy():
+                    poll = min(max(poll * 2, 0.0002), busy_poll)
+                else:
+                    poll = 0
+                timeout = poll
+            else:
+                deadlines = [due for due in (display_due, lcd_due)
+                             if due is not None]
+                deadlines.extend(session.next_read for session
+                                 in self.sessions.values()
+                                 if session not in reading)
+                timeout = (max(min(deadlines) - now, 0) if deadlines
+                           else None)
+
+            ready = [key.data for key, events in selector.select(timeout)]
+            if "keys" in ready:
+                ready.remove("keys")
+                self.read_events(key_handler.handle_key)
+            # the session on show first, then the background ones
+            ready.sort(key=lambda session: session is not self.session)
+            for session in ready:
+                if session is not self.session:
+                    session.next_read = now + BACKGROUND_INTERVAL
+                if not self._read_output(session):
+                    # bash has exited
+                    selector.unregister(session.fd)
+                    reading.discard(session)
+                    self._close_session(session)
+                    if not self.sessions:
+                        return
+
+            now = time.monotonic()
+            changed = self._generation != seen
+            seen = self._generation
+
+            if upload is not None:
+                try:
+                    next(upload)
+                except StopIteration:
+                    upload = None
+                    self._frame_shown()
+                    display_due = now # look again straight away
+                except pervasive.DisplayError as e:
+                    upload = None
+                    self._frame_failed(e)
+                    display_due = now
+            elif changed or (display_due is not None and now >= display_due):
+                ready, timeout = self._render_frame()
+                if ready:
+                    upload = self.display.refresh_steps(self._pack_frame(),
+                                                        self._newer_frame)
+                display_due = None if timeout is None else now + timeout
+
+            if self.use_lcd and (changed or
+                                 (lcd_due is not None and now >= lcd_due)):
+                timeout = self._update_lcd()
+                lcd_due = None if timeout is None else now + timeout
 
     def _subterm(self, rows, columns, rows_above_cursor=1, columns_before_cursor=5):
         screen = self.screen.display
@@ -209,46 +910,80 @@ class PaperTerm(ExclusiveKeyReader):
             
                            
             
+    def _key_handler(self, write):
+        """Make the KeyHandler for this terminal, handing the bytes for
+        each keypress to `write`."""
+        def feed_fn(data):
+            write(data)
+            self._notify_change(keypress=True)
+            if self.scroll_offset:
+                # typing jumps back to the live screen
+                self.scroll_offset = 0
+                self._view_changed = True
+                self._notify_change()
+
+        actions = {
+            "S-KEY_PAGEUP": lambda: self.scroll(1),
+            "S-KEY_PAGEDOWN": lambda: self.scroll(-1),
+        }
+        for number in range(1, 10):
+            actions["A-KEY_F%d" % number] = (
+                lambda number=number: self.switch_session(number))
+        return KeyHandler(self, feed_fn, actions=actions, keymap=self.keymap)
+
     def start(self):
         """Start driving the terminal emulator and display."""
 
-        # bash will run in a separate thread
-        child_pid, self.bash_fd = pty.fork()
+        if self.stats_file:
+            self.stats.write_every(self.stats_file, self.stats_interval)
+        if self.stats_socket:
+            self.stats.serve(self.stats_socket)
+
+        # bash will run in a separate process
+        self.session.spawn()
+        self._mark("bash")
+
+        key_handler = self._key_handler(
+            lambda data: os.write(self.session.fd, data))
+        if self.trace:
+            handle_key = key_handler.handle_key
+            def traced_key(code, value):
+                self.trace.key(code, value)
+                handle_key(code, value)
+            key_handler.handle_key = traced_key
+
+        if self.use_event_loop:
+            # bash's output waits in the PTY while the hardware comes up
+            self._init_hardware()
+            self._run_event_loop(key_handler) # loops until bashes exit
+            return
+
+        # otherwise, start reading from bash while the hardware comes up,
+        self.bash_thread = self._start_reader(self.session)
+        self._init_hardware()
 
-        if child_pid == 0:
-            #if we're in the child thread, start bash
-            os.execlp("/bin/bash", "PaperTerm", "-i")
-            
-        else:
-
-            # otherwise, start reading from bash,
-            self.bash_thread = Thread(target=self._read_bash)
-            self.bash_thread.daemon = True # die if main thread ends
-            self.bash_thread.start()
-
-            if self.use_lcd:
-                # writing to the lcd
-                self.lcd_thread = Thread(target=self._write_lcd)
-                self.lcd_thread.daemon = True # die with main thread
-                self.lcd_thread.start()
-
-            # writing to the display, 
-            self.display_thread = Thread(target=self._write_display)
-            self.display_thread.daemon = True # die with main thread
-            self.display_thread.start()
+        if self.use_lcd:
+            # writing to the lcd
+            self.lcd_thread = Thread(target=self._write_lcd)
+            self.lcd_thread.daemon = True # die with main thread
+            self.lcd_thread.start()
 
-            # and reading from the keyboard
-            def feed_fn(asc):
-                os.write(self.bash_fd, bytes(chr(asc), "utf-8"))
-                self.last_keypress = datetime.now()
+        # writing to the display, 
+        self.display_thread = Thread(target=self._write_display)
+        self.display_thread.daemon = True # die with main thread
+        self.display_thread.start()
 
-            key_handler = KeyHandler(self, feed_fn)
-            key_handler.run() # loops until program end
+        # and reading from the keyboard
+        key_handler.run() # loops until program end
 
     def __exit__(self, *args, **kwargs):
         if self.use_lcd:
             self.lcd.clear()
             self.lcd.backlight(0)
+        if self.display_process and self.display:
+            self.display.close()
+        if self.trace:
+            self.trace.close()
             
 if __name__ == "__main__":
     with PaperTerm("/dev/input/event0", "/dev/ttyS0", use_lcd=True) as term:
@@ -1,8 +1,8 @@
-import spidev
 from array import *
-import RPi.GPIO as GPIO
 import time
 
+from stats import Stats
+
 commands = {
     "reset_data_pointer": [0x20, 0x0D, 0x00],
     "update_display": [0x24, 0x01, 0x00],
@@ -11,53 +11,376 @@ commands = {
     "get_device_info": [0x30, 0x01, 0x01, 0x00],
 }
 
+# the length byte of an upload command tops out at 0xFA
+MAX_CHUNK_SIZE = 0xFA
+
+# board pin numbers
+BUSY_PIN = 16 # low=busy
+TCOM_PIN = 12
+
+# seconds of each wait for BUSY to rise, after which the pin is read
+# again, in case the edge came before the wait was armed
+BUSY_SLICE = 0.005
+
+# the status word that starts every response to a command carried out
+STATUS_OK = [0x90, 0x00]
+
+class DisplayError(Exception):
+    """The panel failed to show a frame."""
+    pass
+
+class DisplayTimeout(DisplayError):
+    """The panel held its BUSY line low for longer than allowed."""
+    pass
+
+class UploadError(DisplayError):
+    """The panel kept rejecting a command."""
+    pass
+
 class PervasiveDisplay(object):
-    def __init__(self):
-        GPIO.setmode(GPIO.BOARD)
-        GPIO.setwarnings(False)
-        # pin 16: low=busy
-        GPIO.setup(16, GPIO.IN)
-        GPIO.setup(12, GPIO.OUT)
+    """Drives a Pervasive Displays e-paper panel through its timing
+    controller over SPI.  `max_speed_hz` sets the SPI clock (spidev's
+    default if None); `chunk_size` is how many bytes of image data go
+    in each upload command, at most MAX_CHUNK_SIZE.
+
+    `gpio` and `spi` default to the `RPi.GPIO` module and an open
+    `spidev.SpiDev`; anything with the same interface (such as the
+    fakes in `fakes`) can be passed instead.  Waiting for the BUSY
+    line gives up with DisplayTimeout after `busy_timeout` seconds.
+
+    Timings of each chunk, BUSY wait and refresh, and the bytes moved
+    over SPI, go into `stats` (a stats.Stats of its own if None).
+
+    Every response's status is checked.  A rejected command is sent
+    again, up to `command_retries` times: the data pointer only moves
+    on once a chunk is accepted, so a bus glitch costs one chunk.
+    Should a chunk still fail, the whole upload is started again from
+    a reset data pointer, up to `frame_retries` times, before
+    UploadError is raised; either way, update_display is never sent
+    for a frame that didn't arrive whole.  `upload_errors`,
+    `chunk_retries` and `frame_restarts` count what happened.
+
+    Given a list of clock `speeds`, each restart, and each frame that
+    needed `slowdown_retries` or more chunk retries, also drops the SPI
+    clock to the next slower one for the rest of the session;
+    see spi_calibration.
+
+    An upload given a `newer` callable asks it for a fresher frame
+    after every chunk; should it return one, the upload starts over
+    with that, so update_display never shows a frame already out of
+    date.  `uploads_superseded` counts how often.
+
+    """
+    def __init__(self, max_speed_hz=None, chunk_size=MAX_CHUNK_SIZE,
+                 gpio=None, spi=None, busy_timeout=10.0, stats=None,
+                 command_retries=3, frame_retries=1, speeds=None,
+                 slowdown_retries=3):
+        if not 0 < chunk_size <= MAX_CHUNK_SIZE:
+            raise ValueError("chunk_size must be between 1 and %d"
+                             % MAX_CHUNK_SIZE)
+
+        if gpio is None:
+            import RPi.GPIO as gpio
+        self.gpio = gpio
+
+        gpio.setmode(gpio.BOARD)
+        gpio.setwarnings(False)
+        gpio.setup(BUSY_PIN, gpio.IN)
+        gpio.setup(TCOM_PIN, gpio.OUT)
 
         # disable and re-enable TCOM
-        GPIO.output(12, GPIO.HIGH)
-        GPIO.output(12, GPIO.LOW)
+        gpio.output(TCOM_PIN, gpio.HIGH)
+        gpio.output(TCOM_PIN, gpio.LOW)
         time.sleep(0.1) # wait for initialization
 
-        self.spi = spidev.SpiDev()
-        self.spi.open(0,0)
-        
-        # self.spi.max_speed_hz = 3000000
+        if spi is None:
+            import spidev
+            spi = spidev.SpiDev()
+            spi.open(0,0)
+        self.spi = spi
+
+        if max_speed_hz:
+            self.spi.max_speed_hz = max_speed_hz
         self.spi.mode = 0b11
         self.spi.bits_per_word = 8
 
+        # one reusable packet for image data: command, then payload
+        self.chunk_size = chunk_size
+        self._packet = bytearray(commands["upload_image_data"][:3])
+        self._packet.extend(bytes(1 + chunk_size))
+
+        # seconds spent in the last send_image
+        self.last_upload_time = None
+
+        # BUSY line statistics: calls to wait_for_ready, how many of
+        # them actually had to wait, and the time spent waiting
+        self.busy_timeout = busy_timeout
+        self.busy_waits = 0
+        self.busy_blocked = 0
+        self.busy_wait_time = 0.0
+        self.busy_wait_max = 0.0
+        self.stats = stats if stats is not None else Stats()
+
+        self.command_retries = command_retries
+        self.frame_retries = frame_retries
+        self.upload_errors = 0
+        self.chunk_retries = 0
+        self.frame_restarts = 0
+        self.uploads_superseded = 0
+        self.speeds = sorted(speeds or [])
+        self.slowdown_retries = slowdown_retries
+
         self.image_header = [0x3a, 0x01, 0xe0, 0x03,
                              0x20, 0x01, 0x04, 0x00,
                              0x00, 0x00, 0x00, 0x00,
                              0x00, 0x00, 0x00, 0x00]
 
     def wait_for_ready(self):
-        while GPIO.input(16) == GPIO.LOW:
-            pass
+        """Return once the panel's BUSY line is high.  Rather than polling,
+        sleep in the GPIO driver until the rising edge, so other threads
+        keep running meanwhile.
+
+        The driver only sees edges after it is armed, and BUSY pulses
+        can be shorter than the gap between reading the pin and arming
+        it, so the wait is cut into BUSY_SLICE pieces with the pin read
+        in between: a missed edge costs one slice, not `busy_timeout`.
+
+        """
+        gpio = self.gpio
+        self.busy_waits += 1
+        if gpio.input(BUSY_PIN) != gpio.LOW:
+            return
+
+        start = time.time()
+        deadline = start + self.busy_timeout
+        self.busy_blocked += 1
+        try:
+            while gpio.input(BUSY_PIN) == gpio.LOW:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise DisplayTimeout("e-paper panel stayed busy for "
+                                         "%.1fs" % (time.time() - start))
+                timeout = min(BUSY_SLICE, remaining)
+                gpio.wait_for_edge(BUSY_PIN, gpio.RISING,
+                                   timeout=max(int(timeout * 1000), 1))
+        finally:
+            self._waited(start)
+
+    def _waited(self, start):
+        """Count a wait for BUSY that began at `start`."""
+        waited = time.time() - start
+        self.busy_wait_time += waited
+        self.busy_wait_max = max(self.busy_wait_max, waited)
+        self.stats.record("wait_for_ready", waited)
     
-    def send_command(self, cmd, data=list()):
+    def busy(self):
+        """Whether the panel is holding its BUSY line low."""
+        return self.gpio.input(BUSY_PIN) == self.gpio.LOW
+
+    def _ready_steps(self):
+        """Yield until the panel's BUSY line is high: wait_for_ready for a
+        cooperative scheduler, counted and timed out the same way."""
+        self.busy_waits += 1
+        if not self.busy():
+            return
+
+        start = time.time()
+        deadline = start + self.busy_timeout
+        self.busy_blocked += 1
+        try:
+            while self.busy():
+                if time.time() >= deadline:
+                    raise DisplayTimeout("e-paper panel stayed busy for "
+                                         "%.1fs" % (time.time() - start))
+                yield
+        finally:
+            self._waited(start)
+
+    def _transfer(self, data):
+        """Clock a buffer out over SPI in one transaction, without copying
+        it into a list if spidev can take it as it is."""
+        self.stats.add("spi_bytes", len(data))
+        if hasattr(self.spi, "writebytes2"):
+            self.spi.writebytes2(data)
+        else: # spidev < 3.4 only takes lists
+            self.spi.xfer2(list(data))
+
+    def send_command(self, cmd, data=b""):
         self.wait_for_ready()
-        self.spi.xfer2(commands[cmd] + data)
+        self._transfer(bytes(commands[cmd]) + bytes(data))
         self.wait_for_ready()
 
     def get_response(self, bytes):
+        self.stats.add("spi_bytes_read", bytes)
         return self.spi.readbytes(bytes)
 
-    def send_image(self, epd_data):
-        out = []
-        self.send_command("upload_header", self.image_header)
-        out.append(self.get_response(2))
-        for index in range(0, len(epd_data), 250):
-            self.send_command("upload_image_data",
-                              epd_data[index:index + 250])
-            out.append(self.get_response(5))
+    def _rejected(self, response):
+        """Whether a response's status says its command failed, counting
+        it if so."""
+        if list(response[:2]) == STATUS_OK:
+            return False
+        self.upload_errors += 1
+        self.stats.add("upload_errors")
+        return True
+
+    def _retry(self, attempt, response):
+        """Count another go at a rejected command, or raise UploadError if
+        `attempt` was the last allowed."""
+        if attempt >= self.command_retries:
+            raise UploadError("panel rejected a command %d times (status %s)"
+                              % (attempt + 1, list(response[:2])))
+        self.chunk_retries += 1
+        self.stats.add("chunk_retries")
+
+    def _restart_frame(self):
+        self.frame_restarts += 1
+        self.stats.add("frame_restarts")
+        self._slow_down()
+
+    def _slow_down(self):
+        """Drop the SPI clock to the next of `speeds` below it, if any."""
+        slower = [hz for hz in self.speeds if hz < self.spi.max_speed_hz]
+        if not slower:
+            return
+        self.spi.max_speed_hz = slower[-1]
+        self.stats.add("spi_slowdowns")
+
+    def _supersede(self):
+        self.uploads_superseded += 1
+        self.stats.add("uploads_superseded")
+
+    def _command(self, packet, response_size):
+        """Send a command and read its response, sending it again while the
+        panel rejects it."""
+        attempt = 0
+        while True:
+            self.wait_for_ready()
+            self._transfer(packet)
+            self.wait_for_ready()
+            response = self.get_response(response_size)
+            if not self._rejected(response):
+                return response
+            self._retry(attempt, response)
+            attempt += 1
+
+    def _image_packets(self, epd_data):
+        """Yield the packets that upload a frame, each with the size of the
+        response to read after it: the header, then the image data
+        sliced straight out of the caller's buffer into one reused
+        packet per chunk.
+
+        """
+        try:
+            data = memoryview(epd_data).cast("B")
+        except TypeError:
+            data = memoryview(bytes(epd_data))
+
+        yield bytes(commands["upload_header"] + self.image_header), 2
+
+        packet = memoryview(self._packet)
+        for index in range(0, len(data), self.chunk_size):
+            chunk = data[index:index + self.chunk_size]
+            size = len(chunk)
+            self._packet[3] = size
+            packet[4:4 + size] = chunk
+            yield packet[:4 + size], 5
+
+    def send_image(self, epd_data, newer=None):
+        """Upload a frame: anything bytes-like (bytes, bytearray,
+        memoryview, a NumPy array) or a list of ints.  If `newer`
+        returns a frame between chunks, upload that instead."""
+        stats, clock = self.stats, self.stats.clock
+        start = time.time()
+        retries = self.chunk_retries
+        attempt = 0
+        while True:
+            try:
+                out = []
+                for packet, response in self._image_packets(epd_data):
+                    begin = clock()
+                    out.append(self._command(packet, response))
+                    stats.record("send_chunk", clock() - begin)
+                    fresher = newer() if newer else None
+                    if fresher is not None:
+                        break
+                else:
+                    break
+                epd_data = fresher
+                self._supersede()
+            except UploadError:
+                if attempt == self.frame_retries:
+                    raise
+                attempt += 1
+                self._restart_frame()
+            self.reset_data_pointer()
+
+        if self.chunk_retries - retries >= self.slowdown_retries:
+            self._slow_down()
+        self.last_upload_time = time.time() - start
+        stats.record("send_image", self.last_upload_time)
         return out
 
+    def _step(self, packet, response_size):
+        """Send one command, as _command does, but yield instead of
+        blocking while the panel is busy."""
+        attempt = 0
+        while True:
+            yield from self._ready_steps()
+            self._transfer(packet)
+            yield from self._ready_steps()
+            response = self.get_response(response_size)
+            yield
+            if not self._rejected(response):
+                return
+            self._retry(attempt, response)
+            attempt += 1
+
+    def refresh_steps(self, epd_data, newer=None):
+        """Generator doing what reset_data_pointer, send_image and
+        update_display do together, for a cooperative scheduler: it
+        yields after every command, and while the panel is busy.
+
+        """
+        stats, clock = self.stats, self.stats.clock
+        reset = bytes(commands["reset_data_pointer"])
+        start = time.time()
+        retries = self.chunk_retries
+        yield from self._step(reset, 2)
+        attempt = 0
+        while True:
+            try:
+                for packet, response in self._image_packets(epd_data):
+                    begin = clock()
+                    yield from self._step(packet, response)
+                    stats.record("send_chunk", clock() - begin)
+                    fresher = newer() if newer else None
+                    if fresher is not None:
+                        break
+                else:
+                    break
+                epd_data = fresher
+                self._supersede()
+            except UploadError:
+                if attempt == self.frame_retries:
+                    raise
+                attempt += 1
+                self._restart_frame()
+            yield from self._step(reset, 2)
+        if self.chunk_retries - retries >= self.slowdown_retries:
+            self._slow_down()
+        self.last_upload_time = time.time() - start
+        stats.record("send_image", self.last_upload_time)
+        start = clock()
+        yield from self._step(bytes(commands["update_display"]), 2)
+        stats.record("update_display", clock() - start)
+
+    def refresh(self, epd_data, newer=None):
+        """Show a frame: reset_data_pointer, send_image and update_display
+        in one go."""
+        self.reset_data_pointer()
+        self.send_image(epd_data, newer)
+        return self.update_display()
+
     def write_image(self, epd_data):
         out = bytes(epd_data)
             
@@ -65,12 +388,13 @@ class PervasiveDisplay(object):
             f.write(out)
 
     def update_display(self):
-        self.send_command("update_display")
-        return self.get_response(2)
+        start = self.stats.clock()
+        response = self._command(bytes(commands["update_display"]), 2)
+        self.stats.record("update_display", self.stats.clock() - start)
+        return response
 
     def get_device_info(self):
         self.send_command("get_device_info")
 
     def reset_data_pointer(self):
-        self.send_command("reset_data_pointer")
-        return self.get_response(2)
+        return self._command(bytes(commands["reset_data_pointer"]), 2)
@@ -0,0 +1,218 @@
+"""Records what bash wrote and which keys were pressed during a PaperTerm
+session, and replays such a trace through the real emulator, renderer
+and frame packer into a FrameSink, with no hardware involved, timing
+each stage and optionally comparing every frame against a saved run.
+
+    python ptytrace.py TRACE [FONT_PATH] [--save FRAMES] [--compare FRAMES]
+
+A trace is a header (magic, rows, columns) followed by records, each
+a RECORD header (seconds since the start, kind, session number,
+payload size) and its payload: the bytes read from the PTY for
+OUTPUT, or a KEY_EVENT's code and value.
+
+"""
+import sys
+import time
+import struct
+from threading import Lock
+
+from epd_frame import WIDTH, HEIGHT
+
+MAGIC = b"PTYTRACE"
+HEADER = struct.Struct("<HH")
+RECORD = struct.Struct("<dBBI")
+KEY_EVENT = struct.Struct("<HB")
+
+# record kinds
+OUTPUT = 0
+KEY = 1
+
+FRAME_SIZE = WIDTH * HEIGHT // 8
+
+class TraceWriter(object):
+    """Appends timestamped PTY output and key events to the trace file
+    at `path`; safe to call from the reader and keyboard threads at
+    once."""
+    def __init__(self, path, rows, cols):
+        self._file = open(path, "wb")
+        self._file.write(MAGIC + HEADER.pack(rows, cols))
+        self._lock = Lock()
+        self._start = time.monotonic()
+
+    def _write(self, kind, session, payload):
+        with self._lock:
+            if self._file:
+                self._file.write(RECORD.pack(time.monotonic() - self._start,
+                                             kind, session, len(payload)))
+                self._file.write(payload)
+
+    def output(self, session, data):
+        self._write(OUTPUT, session, data)
+
+    def key(self, code, value):
+        self._write(KEY, 0, KEY_EVENT.pack(code, value))
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+def read_trace(path):
+    """Return the (rows, cols) of a trace, and its records as (time,
+    kind, session, data) tuples, where a KEY record's data is a (code,
+    value) pair."""
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a PTY trace" % path)
+        rows, cols = HEADER.unpack(f.read(HEADER.size))
+        records = []
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                break # the end, or a trace cut short
+            stamp, kind, session, size = RECORD.unpack(header)
+            data = f.read(size)
+            if kind == KEY:
+                data = KEY_EVENT.unpack(data)
+            records.append((stamp, kind, session, data))
+    return (rows, cols), records
+
+class FrameSink(object):
+    """Stands in for the e-paper display: keeps every frame it is sent,
+    in `frames`, or appended to the file at `path`."""
+    def __init__(self, path=None):
+        self.frames = []
+        self.count = 0
+        self.last_upload_time = 0.0
+        self._file = open(path, "wb") if path else None
+
+    def busy(self):
+        return False
+
+    def refresh(self, epd_data, newer=None):
+        data = bytes(epd_data)
+        if self._file:
+            self._file.write(data)
+        else:
+            self.frames.append(data)
+        self.count += 1
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+def read_frames(path, size=FRAME_SIZE):
+    """Yield the frames in a file written by a FrameSink."""
+    with open(path, "rb") as f:
+        while True:
+            frame = f.read(size)
+            if len(frame) < size:
+                return
+            yield frame
+
+def compare_frames(frames, expected):
+    """Return the index of the first frame that differs from `expected`
+    (or is missing from either), or None if they are all the same."""
+    for index, (frame, other) in enumerate(zip(frames, expected)):
+        if frame != other:
+            return index
+    if len(frames) != len(expected):
+        return min(len(frames), len(expected))
+    return None
+
+def replay(path, font_path=None, sink=None):
+    """Feed the trace at `path` through a PaperTerm driving `sink` (a new
+    FrameSink if None), drawing a frame after every record.  Return the
+    terminal, whose `stats` hold the timings, the sink, and the seconds
+    the replay took, setting up aside.
+
+    The refresh scheduler is told never to wait and flood mode is off,
+    so the frames depend only on the trace, not on how fast it plays.
+    Keys that would quit or start a bash do neither.
+
+    """
+    from fakes import FakeInputDevice
+    from scheduler import RefreshScheduler
+    from session import Session
+    from main import PaperTerm
+
+    (rows, cols), records = read_trace(path)
+    if sink is None:
+        sink = FrameSink()
+
+    term = PaperTerm(FakeInputDevice(), None, rows=rows, cols=cols,
+                     display=sink, font_path=font_path,
+                     scheduler=RefreshScheduler(debounce=0, max_staleness=0,
+                                                min_interval=0),
+                     flood_rate=float("inf"))
+    term._init_hardware()
+
+    # every session that wrote anything is there from the start, and
+    # switching to any other opens an empty one, so no bash is started
+    for stamp, kind, number, data in records:
+        if kind == OUTPUT and number not in term.sessions:
+            term.sessions[number] = Session(number, cols, rows)
+    term._share_scrollback()
+    def open_session(number):
+        session = term.sessions[number] = Session(number, cols, rows)
+        term._share_scrollback()
+        return session
+    term._open_session = open_session
+
+    # a trace of a whole session ends with the F1 that quit it
+    keys = term._key_handler(lambda data: None)
+    keys.quit = lambda: None
+    start = time.perf_counter()
+    for stamp, kind, number, data in records:
+        if kind == OUTPUT:
+            term._feed_output(term.sessions[number], data)
+        else:
+            keys.handle_key(*data)
+
+        ready, timeout = term._render_frame()
+        if ready:
+            sink.refresh(term._pack_frame())
+            term._frame_shown()
+    return term, sink, time.perf_counter() - start
+
+def main(args):
+    options = {}
+    for option in ("--save", "--compare"):
+        if option in args:
+            index = args.index(option)
+            options[option] = args[index + 1]
+            del args[index:index + 2]
+    trace_path, font_path = args[0], (args[1:2] or [None])[0]
+
+    sink = FrameSink(options.get("--save"))
+    term, sink, elapsed = replay(trace_path, font_path, sink)
+    sink.close()
+
+    report = term.stats.report()
+    parsed = report["counters"].get("bytes_parsed", 0)
+    print("replayed %d bytes in %.2fs (%.0f KB/s), %d frames"
+          % (parsed, elapsed, parsed / elapsed / 1024, sink.count))
+    for name in ("feed", "render", "pack"):
+        timer = report["timers"].get(name)
+        if timer:
+            print("%-7s %7d x  mean %8.5fs  p90 %8.5fs  max %8.5fs"
+                  % (name, timer["count"], timer["mean"], timer["p90"],
+                     timer["max"]))
+
+    if "--compare" in options:
+        frames = (sink.frames if "--save" not in options
+                  else list(read_frames(options["--save"])))
+        expected = list(read_frames(options["--compare"]))
+        differs = compare_frames(frames, expected)
+        if differs is None:
+            print("all %d frames identical" % len(frames))
+        else:
+            print("frame %d differs (%d frames, %d expected)"
+                  % (differs, len(frames), len(expected)))
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
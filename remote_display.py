@@ -0,0 +1,240 @@
+import time
+import multiprocessing
+from multiprocessing import shared_memory
+
+import pervasive
+from pervasive import DisplayError, DisplayTimeout
+from epd_frame import WIDTH, HEIGHT
+from stats import Stats
+
+# the statistics a worker sends back after each frame
+_STATS = ("last_upload_time", "busy_waits", "busy_blocked",
+          "busy_wait_time", "busy_wait_max", "upload_errors",
+          "chunk_retries", "frame_restarts", "uploads_superseded")
+
+# seconds between asking for a newer frame while one is going up
+NEWER_POLL = 0.05
+
+# the fields of the control array shared with the worker: newer frames
+# posted and taken during this upload, whether it is too late to post
+# one (update_display is under way), and where the last one posted is
+POSTED, TAKEN, CLOSED, OFFSET, SIZE = range(5)
+
+def _serve(factory, kwargs, shm_name, control, conn):
+    """The worker process: open the display, then upload every frame the
+    parent leaves in shared memory, replying with the display's
+    statistics (or the error) once each has been shown, and handing
+    back what its Stats recorded meanwhile.  A newer frame posted
+    through `control` while one is going up replaces it."""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    display = factory(**kwargs)
+    views = []
+
+    def take():
+        # called with the control lock held
+        if control[POSTED] == control[TAKEN]:
+            return None
+        control[TAKEN] = control[POSTED]
+        views.append(shm.buf[control[OFFSET]:control[OFFSET] + control[SIZE]])
+        return views[-1]
+
+    def newer():
+        with control.get_lock():
+            return take()
+
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            request = None
+        if request is None:
+            break
+
+        offset, size = request
+        views.append(shm.buf[offset:offset + size])
+        try:
+            display.reset_data_pointer()
+            display.send_image(views[-1], newer)
+            while True:
+                # once nothing newer is posted, close the upload, so
+                # none can be posted too late to be shown
+                with control.get_lock():
+                    fresher = take()
+                    if fresher is None:
+                        control[CLOSED] = 1
+                        break
+                display.uploads_superseded += 1
+                display.stats.add("uploads_superseded")
+                display.reset_data_pointer()
+                display.send_image(fresher, newer)
+            display.update_display()
+        except Exception as e:
+            reply = ("error", (type(e).__name__, str(e)))
+        else:
+            reply = ("ok", dict((name, getattr(display, name))
+                                for name in _STATS))
+        finally:
+            for view in views:
+                view.release()
+            del views[:]
+        conn.send(reply + (display.stats.state(),))
+        display.stats.reset()
+    shm.close()
+
+class RemoteDisplay(object):
+    """Stands in for a PervasiveDisplay, running the real one in a worker
+    process so SPI transfers and BUSY waits never hold up the terminal,
+    and can use another core.  Finished frames are handed over in a
+    block of shared memory, big enough for two frames of `size` bytes;
+    only where they are goes through the pipe.  While one frame goes
+    up, a `newer` one may be put in the other half, and is taken
+    between chunks, as PervasiveDisplay.send_image would.
+
+    The worker builds its display by calling `factory(**kwargs)`, both
+    of which must be picklable.  If a frame hasn't been shown within
+    `timeout` seconds, the worker is killed and a fresh one started,
+    and DisplayTimeout is raised, as it is if the worker dies.  An
+    error the worker's display raised is raised again here as the
+    same DisplayError subclass (DisplayError itself, for anything
+    else), so a rejected upload still looks like one.
+
+    What the worker's display records is merged into `stats`, along
+    with the time each "refresh" took as seen from this side.
+
+    """
+    def __init__(self, factory=pervasive.PervasiveDisplay, kwargs=None,
+                 size=WIDTH * HEIGHT // 8, timeout=30.0, stats=None):
+        self.factory = factory
+        self.kwargs = kwargs or {}
+        self.timeout = timeout
+        self.stats = stats if stats is not None else Stats()
+
+        self.size = size
+        self.shm = shared_memory.SharedMemory(create=True, size=2 * size)
+        self._context = multiprocessing.get_context("spawn")
+        self._control = self._context.Array("l", 5)
+        self._half = 0 # where the frame going up is
+        self._process = None
+        self._conn = None
+        self._start()
+
+        self.in_flight = False
+        self.restarts = 0
+        self.errors = 0
+        for name in _STATS:
+            setattr(self, name, 0)
+        self.last_upload_time = None
+
+    def _start(self):
+        self._conn, child = self._context.Pipe()
+        self._process = self._context.Process(
+            target=_serve, args=(self.factory, self.kwargs,
+                                 self.shm.name, self._control, child))
+        self._process.daemon = True
+        self._process.start()
+        child.close()
+
+    def _restart(self):
+        """Replace a worker that has stopped answering."""
+        self._process.kill()
+        self._process.join()
+        self._conn.close()
+        self.restarts += 1
+        self.in_flight = False
+        self._start()
+
+    def busy(self):
+        """Whether a frame is still being uploaded or shown."""
+        return self.in_flight
+
+    def _put(self, epd_data):
+        """Copy a frame into the half of shared memory not in use, and
+        return its offset and size."""
+        data = memoryview(epd_data).cast("B")
+        self._half ^= 1
+        offset = self._half * self.size
+        self.shm.buf[offset:offset + len(data)] = data
+        return offset, len(data)
+
+    def _submit(self, epd_data):
+        with self._control.get_lock():
+            self._control[:] = [0] * 5
+        self._conn.send(self._put(epd_data))
+        self.in_flight = True
+        self._submitted = self.stats.clock()
+        return time.monotonic() + self.timeout
+
+    def _offer(self, newer):
+        """Post the frame `newer` returns, if any, for the worker to
+        upload instead, unless it hasn't taken the last one yet or has
+        finished uploading."""
+        control = self._control
+        with control.get_lock():
+            if control[CLOSED] or control[POSTED] != control[TAKEN]:
+                return
+            fresher = newer()
+            if fresher is not None:
+                control[OFFSET], control[SIZE] = self._put(fresher)
+                control[POSTED] += 1
+
+    def _finish(self):
+        try:
+            status, result, state = self._conn.recv()
+        except EOFError:
+            # the worker died; the next frame gets a new one
+            self.errors += 1
+            self._restart()
+            raise DisplayTimeout("display worker exited")
+        self.in_flight = False
+        self.stats.record("refresh", self.stats.clock() - self._submitted)
+        self.stats.merge(state)
+        if status != "ok":
+            self.errors += 1
+            name, message = result
+            error = getattr(pervasive, name, None)
+            if not (isinstance(error, type) and
+                    issubclass(error, DisplayError)):
+                error, message = DisplayError, "%s: %s" % (name, message)
+            raise error(message)
+        for name, value in result.items():
+            setattr(self, name, value)
+
+    def refresh(self, epd_data, newer=None):
+        """Show a frame, as PervasiveDisplay.refresh does, blocking until
+        the worker has sent it, and asking `newer` for a fresher one
+        every NEWER_POLL seconds meanwhile."""
+        deadline = self._submit(epd_data)
+        while not self._conn.poll(min(max(deadline - time.monotonic(), 0),
+                                      NEWER_POLL if newer else self.timeout)):
+            if time.monotonic() > deadline:
+                self._restart()
+                raise DisplayTimeout("display worker stuck for %.1fs"
+                                     % self.timeout)
+            if newer:
+                self._offer(newer)
+        self._finish()
+
+    def refresh_steps(self, epd_data, newer=None):
+        """Generator version of `refresh`, for a cooperative scheduler,
+        yielding until the worker has sent the frame."""
+        deadline = self._submit(epd_data)
+        while not self._conn.poll():
+            if time.monotonic() > deadline:
+                self._restart()
+                raise DisplayTimeout("display worker stuck for %.1fs"
+                                     % self.timeout)
+            if newer:
+                self._offer(newer)
+            yield
+        self._finish()
+
+    def close(self):
+        if self._process.is_alive():
+            if self.in_flight:
+                self._process.kill()
+            else:
+                self._conn.send(None)
+            self._process.join(self.timeout)
+        self._conn.close()
+        self.shm.close()
+        self.shm.unlink()
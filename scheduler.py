@@ -0,0 +1,115 @@
+import time
+
+class RefreshScheduler(object):
+    """Decides when the e-paper panel should refresh.
+
+    A refresh is due once a change is pending and either there has
+    been no keyboard or screen activity for `debounce` seconds, or the
+    oldest unshown change is `max_staleness` seconds old, so neither a
+    fast typist nor a chatty build can hold the panel off for good.
+    Refreshes never start less than `min_interval` seconds apart, and
+    changes that arrive while one is pending or in flight are
+    coalesced into the next.
+
+    Counters: `frames` started, `deferred` (frames that had to wait
+    for the debounce or the minimum interval), `coalesced` (changes
+    folded into a frame already pending or in flight), `dropped`
+    (pending frames abandoned because nothing visible had changed),
+    `skipped` (chances to draw passed over while output was flooding
+    in) and `restarted` (uploads begun again with newer content).
+
+    """
+    def __init__(self, debounce=0.5, max_staleness=3.0, min_interval=1.0,
+                 clock=time.monotonic):
+        self.debounce = debounce
+        self.max_staleness = max_staleness
+        self.min_interval = min_interval
+        self.clock = clock
+
+        self.pending_since = None # time of the oldest unshown change
+        self.last_activity = None # time of the latest change or keypress
+        self.last_refresh = None # start of the latest refresh
+        self.in_flight = False
+
+        self.frames = 0
+        self.deferred = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.skipped = 0
+        self.restarted = 0
+        self._was_deferred = False
+
+    @property
+    def pending(self):
+        return self.pending_since is not None
+
+    def note_input(self):
+        """Record a keypress, which restarts the debounce."""
+        self.last_activity = self.clock()
+
+    def note_change(self):
+        """Record a change to the screen."""
+        now = self.clock()
+        self.last_activity = now
+        if self.pending_since is None:
+            self.pending_since = now
+            if self.in_flight:
+                self.coalesced += 1
+        else:
+            self.coalesced += 1
+
+    def delay(self, debounce=True):
+        """Return how many seconds until a refresh may start, 0 if one may
+        start now, or None if there is nothing to show.  Without
+        `debounce`, only the staleness deadline makes one due."""
+        if self.pending_since is None:
+            return None
+
+        due = self.pending_since + self.max_staleness
+        if debounce and self.last_activity is not None:
+            due = min(due, self.last_activity + self.debounce)
+        if self.last_refresh is not None:
+            due = max(due, self.last_refresh + self.min_interval)
+
+        wait = max(due - self.clock(), 0)
+        if wait and not self._was_deferred:
+            self.deferred += 1
+            self._was_deferred = True
+        return wait
+
+    def begin(self):
+        """A refresh is starting; it shows every change noted so far."""
+        self.frames += 1
+        self.in_flight = True
+        self.last_refresh = self.clock()
+        self.pending_since = None
+        self._was_deferred = False
+
+    def restart(self):
+        """The refresh in flight is starting over, to show every change
+        noted so far as well."""
+        self.restarted += 1
+        self.pending_since = None
+
+    def end(self):
+        """The refresh has been handed to the panel."""
+        self.in_flight = False
+
+    def drop(self):
+        """Abandon the pending frame; nothing visible changed after all."""
+        if self.pending_since is not None:
+            self.dropped += 1
+            self.pending_since = None
+            self._was_deferred = False
+
+    def skip(self):
+        """Pass over a chance to draw, because output is flooding in."""
+        self.skipped += 1
+
+    def stats(self):
+        return {"frames": self.frames,
+                "deferred": self.deferred,
+                "coalesced": self.coalesced,
+                "dropped": self.dropped,
+                "skipped": self.skipped,
+                "restarted": self.restarted}
@@ -0,0 +1,129 @@
+import mmap
+from array import array
+from collections import deque
+
+from cellscreen import CellScreen
+
+class Scrollback(object):
+    """Rows that have scrolled off the top of the screen, kept as
+    CellScreen cell codes, four bytes a cell with trailing blanks
+    trimmed, in a ring buffer of `budget` bytes; the oldest rows are
+    forgotten to make room for new ones.  Codes rather than text keep
+    wide characters' stubs and combined characters a cell each, so
+    history lines up with the screen column for column.  With
+    `spill_path`, the ring lives in a memory-mapped file there rather
+    than in RAM, so the kernel can page it out.
+
+    Rows are indexed oldest first.
+
+    """
+    def __init__(self, budget=262144, spill_path=None):
+        self.budget = budget
+        if spill_path:
+            self._file = open(spill_path, "w+b")
+            self._file.truncate(budget)
+            self._buffer = mmap.mmap(self._file.fileno(), budget)
+        else:
+            self._file = None
+            self._buffer = bytearray(budget)
+
+        # (position, length) of each row, where positions count bytes
+        # ever written, so position % budget is where a row lives
+        self._rows = deque()
+        self._end = 0
+
+    def __len__(self):
+        return len(self._rows)
+
+    def append(self, codes):
+        """Save a row given as an array("I") of cell codes."""
+        used = len(codes)
+        while used and codes[used - 1] == 32:
+            used -= 1
+        data = codes[:min(used, self.budget // codes.itemsize)].tobytes()
+        size = len(data)
+
+        # rows never wrap around the end of the buffer
+        start = self._end
+        if start % self.budget + size > self.budget:
+            start += self.budget - start % self.budget
+        end = start + size
+
+        rows = self._rows
+        while rows and rows[0][0] < end - self.budget:
+            rows.popleft()
+
+        offset = start % self.budget
+        self._buffer[offset:offset + size] = data
+        rows.append((start, size))
+        self._end = end
+
+    def rows(self, start, stop):
+        """Return rows `start` up to `stop` as arrays of cell codes."""
+        start, stop = max(start, 0), min(stop, len(self._rows))
+        out = []
+        for index in range(start, stop):
+            position, size = self._rows[index]
+            offset = position % self.budget
+            row = array("I")
+            row.frombytes(self._buffer[offset:offset + size])
+            out.append(row)
+        return out
+
+    def resize(self, budget):
+        """Change the budget to `budget` bytes, keeping as many of the
+        newest rows as fit."""
+        if budget == self.budget:
+            return
+
+        kept, size = [], 0
+        for position, length in reversed(self._rows):
+            if size + length > budget:
+                break
+            offset = position % self.budget
+            kept.append(bytes(self._buffer[offset:offset + length]))
+            size += length
+
+        if self._file:
+            self._buffer.close()
+            self._file.truncate(budget)
+            self._buffer = mmap.mmap(self._file.fileno(), budget)
+        else:
+            self._buffer = bytearray(budget)
+        self.budget = budget
+
+        # packed from the start of the new buffer, so nothing wraps
+        self._rows.clear()
+        self._end = 0
+        for data in reversed(kept):
+            end = self._end + len(data)
+            self._buffer[self._end:end] = data
+            self._rows.append((self._end, len(data)))
+            self._end = end
+
+    def clear(self):
+        self._rows.clear()
+
+    def close(self):
+        if self._file:
+            self._buffer.close()
+            self._file.close()
+            self._file = None
+
+
+class ScrollbackScreen(CellScreen):
+    """A CellScreen that saves each row scrolling off the top into a
+    Scrollback, instead of keeping history as Char objects the way
+    pyte.HistoryScreen does.
+
+    """
+    def __init__(self, columns, lines, scrollback):
+        self.scrollback = scrollback
+        CellScreen.__init__(self, columns, lines)
+
+    def index(self):
+        top = self.margins.top if self.margins else 0
+        bottom = self.margins.bottom if self.margins else self.lines - 1
+        if top == 0 and self.cursor.y == bottom:
+            self.scrollback.append(self.copy_row(top)[0])
+        CellScreen.index(self)
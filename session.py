@@ -0,0 +1,57 @@
+import os
+import pty
+import codecs
+import pyte
+
+from scrollback import Scrollback, ScrollbackScreen
+
+class Session(object):
+    """One shell: an interactive bash on its own PTY, with the VT102
+    emulator it writes to and a Scrollback of `scrollback_bytes`
+    (mapped from `scrollback_file`, if given).  `number` is the slot
+    it is switched to by.
+
+    The screen exists as soon as the session does, but bash only runs
+    once `spawn` is called.
+
+    """
+    def __init__(self, number, cols, rows, scrollback_bytes=262144,
+                 scrollback_file=None):
+        self.number = number
+        self.scrollback = Scrollback(scrollback_bytes, scrollback_file)
+        self.screen = ScrollbackScreen(cols, rows, self.scrollback)
+        self.stream = pyte.Stream()
+        self.stream.attach(self.screen)
+
+        # invalid bytes become U+FFFD rather than losing the whole read,
+        # and sequences split between reads are carried over
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+        self.pid = None
+        self.fd = None
+        # while in the background, when its PTY may next be read
+        self.next_read = 0
+
+    def spawn(self):
+        """Fork bash on a new PTY."""
+        pid, fd = pty.fork()
+        if pid == 0:
+            # in the child, become bash
+            os.execlp("/bin/bash", "PaperTerm", "-i")
+        self.pid, self.fd = pid, fd
+
+    def feed(self, data):
+        """Feed bytes read from the PTY to the emulator."""
+        self.stream.feed(self.decoder.decode(data))
+
+    def close(self):
+        """Release the PTY and scrollback once bash has gone away."""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if self.pid is not None:
+            try:
+                os.waitpid(self.pid, os.WNOHANG)
+            except ChildProcessError:
+                pass
+        self.scrollback.close()
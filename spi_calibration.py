@@ -0,0 +1,77 @@
+"""Finds a safe SPI clock for a particular panel's timing controller, by
+uploading test patterns at rising speeds until it starts rejecting
+chunks, and remembers the answer for next time.
+
+"""
+import os
+import random
+
+from pervasive import PervasiveDisplay, DisplayError
+from fontcache import CACHE_DIR, load_cache, save_cache
+from epd_frame import WIDTH, HEIGHT
+
+CACHE_FILE = os.path.join(CACHE_DIR, "spi.json")
+
+# clock speeds tried, slowest first
+SPEEDS = [500000, 1000000, 2000000, 4000000, 6000000, 8000000,
+          12000000, 16000000, 20000000, 24000000, 32000000]
+
+def patterns(size=WIDTH * HEIGHT // 8):
+    """Frames that exercise the bus: all white, all black, alternating
+    bits, and noise."""
+    noise = random.Random(0).getrandbits(size * 8).to_bytes(size, "little")
+    return [bytes(size), b"\xff" * size, b"\xaa\x55" * (size // 2), noise]
+
+def calibrate(display, speeds=SPEEDS, rounds=1):
+    """Upload every test pattern `rounds` times at each of `speeds` in
+    turn, with retries off, until one is rejected; leave `display`
+    clocked one speed below the fastest that got through cleanly, as a
+    margin for a warmer day or a longer cable (the slowest, if none
+    did), and return it.  Nothing is shown, since update_display is
+    never sent.
+
+    """
+    retries = display.command_retries, display.frame_retries
+    display.command_retries = display.frame_retries = 0
+    speeds = sorted(speeds)
+    clean = []
+    try:
+        for hz in speeds:
+            display.spi.max_speed_hz = hz
+            try:
+                for i in range(rounds):
+                    for pattern in patterns():
+                        display.reset_data_pointer()
+                        display.send_image(pattern)
+            except DisplayError:
+                break
+            clean.append(hz)
+    finally:
+        display.command_retries, display.frame_retries = retries
+
+    best = clean[-2] if len(clean) > 1 else speeds[0]
+    display.spi.max_speed_hz = best
+    return best
+
+def load_speed(key, cache_file=CACHE_FILE):
+    return load_cache(cache_file).get(key)
+
+def save_speed(key, hz, cache_file=CACHE_FILE):
+    cache = load_cache(cache_file)
+    cache[key] = hz
+    save_cache(cache, cache_file)
+
+def calibrated_display(key="spi0.0", speeds=SPEEDS, cache_file=CACHE_FILE,
+                       **kwargs):
+    """Open a PervasiveDisplay (passing on `kwargs`) clocked at the speed
+    saved for the panel called `key`, calibrating it first if none has
+    been.  Should it start failing later, the display slows down
+    through `speeds` by itself; that lasts only for this session, so
+    one bad spell doesn't slow every session after it.
+
+    """
+    hz = load_speed(key, cache_file)
+    display = PervasiveDisplay(max_speed_hz=hz, speeds=speeds, **kwargs)
+    if hz is None:
+        save_speed(key, calibrate(display, speeds), cache_file)
+    return display
@@ -0,0 +1,147 @@
+import os
+import json
+import time
+import socket
+from threading import Thread
+
+# histogram bucket i holds durations under 2**i microseconds
+BUCKETS = 32
+
+class Histogram(object):
+    """Durations, counted into power-of-two buckets of microseconds; so
+    recording one is a few integer operations, and percentiles come
+    out to within a factor of two."""
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * BUCKETS
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.buckets[min(int(seconds * 1e6).bit_length(), BUCKETS - 1)] += 1
+
+    def percentile(self, fraction):
+        """The upper bound of the bucket holding the `fraction` quantile,
+        in seconds."""
+        wanted = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= wanted:
+                return min(2 ** index / 1e6, self.max)
+        return 0.0
+
+    def summary(self):
+        return {"count": self.count,
+                "mean": self.total / self.count if self.count else 0.0,
+                "max": self.max,
+                "p50": self.percentile(0.5),
+                "p90": self.percentile(0.9),
+                "p99": self.percentile(0.99)}
+
+class Stats(object):
+    """Always-on counters and per-stage timing histograms for the whole
+    pipeline, shared by everything that takes part in it.
+
+    Stages time themselves with `clock` and hand the difference to
+    `record`; counts go through `add`.  Updates take no lock, relying
+    on the GIL, so a racing pair can now and then lose a count.
+
+    """
+    clock = staticmethod(time.perf_counter)
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters = {}
+        self.timers = {}
+
+    def add(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def record(self, name, seconds):
+        try:
+            timer = self.timers[name]
+        except KeyError:
+            timer = self.timers[name] = Histogram()
+        timer.record(seconds)
+
+    def state(self):
+        """Everything recorded, in plain types, for `merge`."""
+        return {"counters": dict(self.counters),
+                "timers": dict((name, (timer.count, timer.total, timer.max,
+                                       list(timer.buckets)))
+                               for name, timer in list(self.timers.items()))}
+
+    def merge(self, state):
+        """Add in the `state` of a Stats kept elsewhere, such as in
+        another process."""
+        for name, value in state["counters"].items():
+            self.add(name, value)
+        for name, (count, total, high, buckets) in state["timers"].items():
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = Histogram()
+            timer.count += count
+            timer.total += total
+            timer.max = max(timer.max, high)
+            timer.buckets = [a + b for a, b in zip(timer.buckets, buckets)]
+
+    def reset(self):
+        self.counters.clear()
+        self.timers.clear()
+
+    def report(self):
+        """A summary of everything, as a dict ready for JSON."""
+        return {"time": time.time(),
+                "uptime": time.time() - self.started,
+                "counters": dict(self.counters),
+                "timers": dict((name, timer.summary())
+                               for name, timer in list(self.timers.items()))}
+
+    def write(self, path):
+        """Write `report` to `path` as JSON, replacing the file whole."""
+        partial = path + ".tmp"
+        with open(partial, "w") as f:
+            json.dump(self.report(), f, indent=1, sort_keys=True)
+        os.replace(partial, path)
+
+    def write_every(self, path, interval=5.0):
+        """Start a thread rewriting the stats file at `path` every
+        `interval` seconds."""
+        def run():
+            while True:
+                time.sleep(interval)
+                self.write(path)
+
+        thread = Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def serve(self, path):
+        """Start a thread answering every connection to the Unix socket at
+        `path` with `report` as JSON, e.g. `socat - UNIX:path`."""
+        if os.path.exists(path):
+            os.unlink(path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen(4)
+
+        def run():
+            while True:
+                conn, addr = server.accept()
+                with conn:
+                    try:
+                        conn.sendall(json.dumps(self.report()).encode("utf-8")
+                                     + b"\n")
+                    except OSError:
+                        pass
+
+        thread = Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread
@@ -0,0 +1,128 @@
+"""Checks CellScreen against plain pyte.Screen by feeding both the same
+random stream of text and escape sequences and comparing them cell by
+cell after every chunk.
+
+Where pyte has a known fault CellScreen deliberately doesn't share (see
+CellScreen's docstring), the reference screen is patched to behave as
+CellScreen does, so the comparison stays exact.
+
+"""
+import collections
+import random
+import unittest
+
+import pyte
+from pyte.screens import StaticDefaultDict
+
+from cellscreen import CellScreen
+
+SEED = 2024
+RUNS = 20
+STEPS = 100
+
+# chunks of input the stream is made of; each %d becomes a number up to
+# a little more than the screen is high
+PIECES = ["hello", "x" * 100, "\r\n", "\n", "\r", "\t", "\b",
+          "漢字", "\xe9", "́", "a⃝", "\xfcn\xef",
+          "\x1b[%dm", "\x1b[1m", "\x1b[7m", "\x1b[0m", "\x1b[31;42m",
+          "\x1b[38;5;%dm", "\x1b[%d;%dH", "\x1b[%dA", "\x1b[%dC",
+          "\x1b[%dJ", "\x1b[%dK", "\x1b[%d@", "\x1b[%dP", "\x1b[%dX",
+          "\x1b[%dL", "\x1b[%dM", "\x1b[%d;%dr", "\x1b[r",
+          "\x1bM", "\x1bD", "\x1bE", "\x1b#8", "\x1b7", "\x1b8",
+          "\x1b[?5h", "\x1b[?5l", "\x1b[?7l", "\x1b[?7h",
+          "\x1b[4h", "\x1b[4l", "\x1b(0lqk\x1b(B"]
+
+class _RefBuffer(collections.defaultdict):
+    # every row counts as stored, so rows deleted or inserted come up
+    # blank whether pyte had stored them or not
+    def __contains__(self, y):
+        return True
+
+    def pop(self, y, default=None):
+        if dict.__contains__(self, y):
+            return dict.pop(self, y)
+        return self[y]
+
+class _Reference(pyte.Screen):
+    """pyte.Screen with the faults CellScreen fixes fixed."""
+    def __init__(self, columns, lines):
+        pyte.Screen.__init__(self, columns, lines)
+        self.buffer = _RefBuffer(lambda: StaticDefaultDict(self.default_char))
+
+    def _clip(self, y):
+        # nothing is kept past the end of the line
+        line = self.buffer[y]
+        for x in [x for x in line if x >= self.columns]:
+            del line[x]
+
+    def insert_characters(self, count=None):
+        # the character pushed off the end of the line is gone
+        pyte.Screen.insert_characters(self, count)
+        self._clip(self.cursor.y)
+
+    def erase_in_display(self, how=0, *args, **kwargs):
+        if how in (0, 1, 2, 3):
+            pyte.Screen.erase_in_display(self, how)
+
+    def erase_in_line(self, how=0, private=False):
+        # with the cursor just past the last column, pyte erases one
+        # cell too many
+        if how in (0, 1, 2):
+            pyte.Screen.erase_in_line(self, how)
+            self._clip(self.cursor.y)
+
+def _piece(rand, lines):
+    piece = rand.choice(PIECES)
+    while "%d" in piece:
+        piece = piece.replace("%d", str(rand.randint(0, lines + 2)), 1)
+    return piece
+
+class CellScreenTest(unittest.TestCase):
+    def assertSame(self, ref, screen, cursor=True):
+        if cursor:
+            self.assertEqual((screen.cursor.x, screen.cursor.y),
+                             (ref.cursor.x, ref.cursor.y))
+        try:
+            display = ref.display
+        except IndexError:
+            # pyte can't show a wide character's stub whose character
+            # was overwritten
+            pass
+        else:
+            self.assertEqual(screen.display, display)
+        for y in range(ref.lines):
+            for x in range(ref.columns):
+                self.assertEqual(screen.buffer[y][x], ref.buffer[y][x],
+                                 "cell (%d, %d)" % (x, y))
+        self.assertEqual(set(screen.dirty),
+                         set(y for y in ref.dirty if y < ref.lines))
+
+    def test_random_streams(self):
+        rand = random.Random(SEED)
+        for run in range(RUNS):
+            columns, lines = rand.choice([(80, 24), (10, 5), (7, 3)])
+            ref, screen = _Reference(columns, lines), CellScreen(columns, lines)
+            ref_stream, stream = pyte.Stream(ref), pyte.Stream(screen)
+            for step in range(STEPS):
+                data = "".join(_piece(rand, lines)
+                               for i in range(rand.randint(1, 5)))
+                ref_stream.feed(data)
+                stream.feed(data)
+                with self.subTest(run=run, step=step, data=data):
+                    self.assertSame(ref, screen)
+                ref.dirty.clear()
+                screen.dirty.clear()
+
+    def test_resize(self):
+        ref, screen = _Reference(20, 6), CellScreen(20, 6)
+        text = "".join("line %d\r\n" % i for i in range(10)) + "abc"
+        pyte.Stream(ref).feed(text)
+        pyte.Stream(screen).feed(text)
+        for lines, columns in [(4, 10), (8, 30), (6, 20)]:
+            ref.resize(lines, columns)
+            screen.resize(lines, columns)
+            # CellScreen keeps the cursor on the screen; pyte doesn't
+            self.assertSame(ref, screen, cursor=False)
+
+if __name__ == "__main__":
+    unittest.main()